@@ -0,0 +1,306 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from . import models, pdf_service, render_pool, storage, zip_stream
+
+
+# Volunteers rendered at the same time; 0 means one per render worker
+BULK_EXPORT_CONCURRENCY = int(os.environ.get("BULK_EXPORT_CONCURRENCY", "0"))
+# Upper bound for a single HTTP export and for ID lists (the CLI has no limit otherwise)
+BULK_EXPORT_MAX_VOLUNTEERS = int(os.environ.get("BULK_EXPORT_MAX_VOLUNTEERS", "1000"))
+# Save profile of the merged print PDF (see pdf_service.SAVE_PROFILES)
+BULK_PDF_SAVE_PROFILE = os.environ.get("BULK_PDF_SAVE_PROFILE", "compact")
+# Memory budget for the whole merged print PDF; forms past it are reported as failed
+BULK_PDF_MEMORY_BUDGET_MB = int(os.environ.get("BULK_PDF_MEMORY_BUDGET_MB", "1024"))
+
+# Finished exports whose progress can still be looked up
+_PROGRESS_HISTORY = 100
+
+# (volunteer_id, filename, pdf bytes or None, error message or None)
+ExportResult = Tuple[int, Optional[str], Optional[bytes], Optional[str]]
+RenderFn = Callable[[int], Optional[Tuple[str, bytes]]]
+
+
+def search_filter(q: str):
+    """Same text search as the volunteer list page."""
+    return or_(
+        models.Volunteer.text1.contains(q),
+        models.Volunteer.text3.contains(q),
+        models.Volunteer.text9.contains(q),
+        models.Volunteer.text10.contains(q)
+    )
+
+
+def select_volunteer_ids(db: Session, ids: Optional[List[int]] = None, q: Optional[str] = None,
+                         group: Optional[str] = None, from_id: Optional[int] = None,
+                         to_id: Optional[int] = None) -> List[int]:
+    """
+    Volunteer IDs matching all given filters, in ID order.
+    `group` matches the group name and code field (text2); there is no
+    registration timestamp, so a day's intake is selected with an ID range.
+    """
+    query = db.query(models.Volunteer.id)
+    if ids:
+        query = query.filter(models.Volunteer.id.in_(ids))
+    if q:
+        query = query.filter(search_filter(q))
+    if group:
+        query = query.filter(models.Volunteer.text2.contains(group))
+    if from_id is not None:
+        query = query.filter(models.Volunteer.id >= from_id)
+    if to_id is not None:
+        query = query.filter(models.Volunteer.id <= to_id)
+    return [row[0] for row in query.order_by(models.Volunteer.id).all()]
+
+
+def parse_ids(value: Optional[str], limit: int = BULK_EXPORT_MAX_VOLUNTEERS) -> Optional[List[int]]:
+    """
+    Parses "1,2,5-9" into a list of IDs. Raises ValueError for malformed input
+    and for more than `limit` IDs, checked before a range is expanded (wider
+    selections use from_id/to_id, which filter in the database).
+    """
+    if not value:
+        return None
+    ids = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+            if end - start + 1 > limit - len(ids):
+                raise ValueError(f"more than {limit} IDs; use from_id/to_id for wide ranges")
+            ids.extend(range(start, end + 1))
+        else:
+            ids.append(int(part))
+            if len(ids) > limit:
+                raise ValueError(f"more than {limit} IDs")
+    return ids
+
+
+class ExportProgress:
+    """Counters for one running export, readable from another request or thread."""
+
+    def __init__(self, total: int, export_id: Optional[str] = None):
+        self.export_id = export_id or uuid.uuid4().hex
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def advance(self, ok: bool):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+
+    def finish(self):
+        self.finished = time.time()
+
+    def as_dict(self) -> dict:
+        end = self.finished or time.time()
+        return {
+            "export_id": self.export_id,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "finished": self.finished is not None,
+            "elapsed_seconds": round(end - self.started, 1),
+        }
+
+
+_progress: "OrderedDict[str, ExportProgress]" = OrderedDict()
+_progress_lock = threading.Lock()
+
+
+def start_progress(total: int, export_id: Optional[str] = None) -> ExportProgress:
+    progress = ExportProgress(total, export_id)
+    with _progress_lock:
+        _progress[progress.export_id] = progress
+        while len(_progress) > _PROGRESS_HISTORY:
+            _progress.popitem(last=False)
+    return progress
+
+
+def get_progress(export_id: str) -> Optional[ExportProgress]:
+    with _progress_lock:
+        return _progress.get(export_id)
+
+
+def render_many(volunteer_ids: List[int], render_fn: RenderFn, progress: Optional[ExportProgress] = None,
+                concurrency: int = 0, on_progress: Optional[Callable[[ExportProgress], None]] = None
+                ) -> Iterator[ExportResult]:
+    """
+    Renders volunteers in parallel and yields results in the order of `volunteer_ids`.
+    Only a small window of renders is in flight, so memory stays bounded for large exports.
+    A failing volunteer is reported in its result instead of stopping the export.
+    """
+    concurrency = concurrency or BULK_EXPORT_CONCURRENCY or max(1, render_pool.RENDER_WORKERS)
+
+    def run(volunteer_id: int) -> ExportResult:
+        try:
+            rendered = render_fn(volunteer_id)
+            if rendered is None:
+                return volunteer_id, None, None, "not found"
+            filename, pdf_bytes = rendered
+            return volunteer_id, filename, pdf_bytes, None
+        except Exception as e:
+            return volunteer_id, None, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-export") as executor:
+        pending = deque()
+        remaining = iter(volunteer_ids)
+        for volunteer_id in remaining:
+            pending.append(executor.submit(run, volunteer_id))
+            if len(pending) >= concurrency * 2:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for volunteer_id in remaining:
+                pending.append(executor.submit(run, volunteer_id))
+                break
+            if result[3]:
+                print(f"[BULK_EXPORT] volunteer {result[0]} failed: {result[3]}")
+            if progress:
+                progress.advance(result[3] is None)
+                if on_progress:
+                    on_progress(progress)
+            yield result
+    if progress:
+        progress.finish()
+
+
+def iter_zip(results: Iterable[ExportResult]) -> Iterator[bytes]:
+    """
+    Streams a ZIP of the rendered PDFs, one entry per volunteer as it finishes.
+    Failures are listed in errors.txt at the end of the archive.
+    """
+    stream = zip_stream.ZipStream()
+    errors = []
+    for volunteer_id, filename, pdf_bytes, error in results:
+        if error:
+            errors.append(f"{volunteer_id}: {error}")
+            continue
+        # The ID prefix keeps volunteers with the same name apart
+        yield stream.write_bytes(f"{volunteer_id}_{filename}", pdf_bytes)
+    if errors:
+        yield stream.write_bytes("errors.txt", ("\n".join(errors) + "\n").encode("utf-8"))
+    yield stream.close()
+
+
+def iter_batch_pdf(volunteer_ids: List[int], render_fn: RenderFn, template_path: str,
+                   progress: Optional[ExportProgress] = None,
+                   on_progress: Optional[Callable[[ExportProgress], None]] = None,
+                   save_profile: Optional[str] = None, concurrency: int = 0) -> Iterator[bytes]:
+    """
+    Assembles all volunteers into one print document that shares a single copy
+    of the template background (see pdf_service.BatchDocument), and yields it
+    once complete. Written as a generator so a streaming response can send its
+    headers up front. `render_fn` returns (filename, fragments.render_batch_parts()
+    result) for an ID, or None; volunteers are rendered in parallel as in
+    render_many, and only inserted here, in order, within one memory budget.
+    """
+    batch = pdf_service.BatchDocument(template_path,
+                                      pdf_service.RenderBudget(BULK_PDF_MEMORY_BUDGET_MB * 1024 * 1024))
+    try:
+        for volunteer_id, _, parts, error in render_many(volunteer_ids, render_fn, None, concurrency):
+            ok = False
+            if error is None:
+                try:
+                    ok = batch.add_form(*parts)
+                    if not ok:
+                        print(f"[BULK_EXPORT] volunteer {volunteer_id} failed: print memory budget spent")
+                except Exception as e:
+                    print(f"[BULK_EXPORT] volunteer {volunteer_id} failed: {e}")
+            if progress:
+                progress.advance(ok)
+                if on_progress:
+                    on_progress(progress)
+        yield batch.save(save_profile or BULK_PDF_SAVE_PROFILE)
+    finally:
+        batch.close()
+        if progress:
+            progress.finish()
+
+
+def _cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.bulk_export",
+        description="Render many volunteer PDFs into a ZIP or one merged print PDF."
+    )
+    parser.add_argument("--ids", help="comma separated IDs or ranges, e.g. 1,2,10-20")
+    parser.add_argument("--q", help="search text, as on the list page")
+    parser.add_argument("--group", help="group name or code (text2)")
+    parser.add_argument("--from-id", type=int)
+    parser.add_argument("--to-id", type=int)
+    parser.add_argument("--format", choices=["zip", "pdf"], default="zip")
+    parser.add_argument("--concurrency", type=int, default=0)
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args(argv)
+
+    try:
+        id_list = parse_ids(args.ids)
+    except ValueError as e:
+        parser.error(f"--ids: {e}")
+
+    # Own cache directory: the server's one is cleared by every process that opens it
+    cache_dir = tempfile.mkdtemp(prefix="vms_bulk_export_")
+    storage.set_storage(storage.create_storage(cache_dir=cache_dir, write_back=False))
+    # Imported here so the module stays importable from volunteer_pdf without a cycle
+    from . import database, volunteer_pdf
+
+    db = database.SessionLocal()
+    try:
+        volunteer_ids = select_volunteer_ids(db, id_list, args.q, args.group, args.from_id, args.to_id)
+    finally:
+        db.close()
+    if not volunteer_ids:
+        print("No volunteers match", file=sys.stderr)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return 1
+
+    def report(progress: ExportProgress):
+        print(f"\r[BULK_EXPORT] {progress.done}/{progress.total} ({progress.failed} failed)",
+              end="", file=sys.stderr, flush=True)
+
+    progress = start_progress(len(volunteer_ids))
+    volunteer_pdf.pdf_render_pool.start()
+    try:
+        if args.format == "zip":
+            chunks = iter_zip(volunteer_pdf.render_many_volunteers(volunteer_ids, progress, args.concurrency, report))
+        else:
+            chunks = volunteer_pdf.render_volunteer_batch(volunteer_ids, progress, args.concurrency, report)
+        temp_path = f"{args.output}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_path, args.output)
+    finally:
+        volunteer_pdf.pdf_render_pool.shutdown()
+        # Folder copies of the renders are written through; wait for anything still queued
+        storage.get_storage().flush()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print(file=sys.stderr)
+
+    summary = progress.as_dict()
+    print(f"[BULK_EXPORT] {summary['done'] - summary['failed']} of {summary['total']} volunteers written to "
+          f"{args.output} in {summary['elapsed_seconds']}s", file=sys.stderr)
+    return 0 if summary["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(_cli())
@@ -0,0 +1,174 @@
+import fitz
+import os
+import threading
+from typing import List, Optional
+
+
+# Font Configuration - check multiple possible font paths
+# PDF_FONT_PATH can point to a specific TTF and is tried first.
+FONT_PATHS = [
+    "C:/Windows/Fonts/arial.ttf",  # Windows
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux (Debian/Ubuntu)
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",  # Linux (Arch)
+    "assets/arial.ttf",  # Bundled font (fallback)
+]
+
+FONT_NAME = "Arial"
+FALLBACK_FONT_NAME = "helv"
+
+
+class FontRegistry:
+    """
+    Resolves and loads the text font once per process.
+    The font file is read into memory a single time; every page registers the
+    same buffer, so PyMuPDF embeds one shared font resource per document.
+    """
+
+    def __init__(self, font_paths: List[str]):
+        self.font_paths = font_paths
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.font_path: Optional[str] = None
+        self.font_name = FALLBACK_FONT_NAME
+        self.font_buffer: Optional[bytes] = None
+        self.measure_font: Optional[fitz.Font] = None
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+
+            candidates = list(self.font_paths)
+            env_path = os.environ.get("PDF_FONT_PATH")
+            if env_path:
+                candidates.insert(0, env_path)
+
+            for fp in candidates:
+                if os.path.exists(fp):
+                    try:
+                        with open(fp, "rb") as f:
+                            buffer = f.read()
+                        self.measure_font = fitz.Font(fontbuffer=buffer)
+                        self.font_buffer = buffer
+                        self.font_path = fp
+                        self.font_name = FONT_NAME
+                        break
+                    except Exception as e:
+                        print(f"Error loading font {fp}: {e}")
+
+            if self.font_buffer is None:
+                print("No TTF font found, falling back to helv")
+                self.measure_font = fitz.Font(FALLBACK_FONT_NAME)
+
+            self._loaded = True
+
+    def ensure_loaded(self) -> "FontRegistry":
+        if not self._loaded:
+            self._load()
+        return self
+
+    def register(self, page: fitz.Page) -> str:
+        """
+        Makes the font available on a page and returns the font name to draw with.
+        """
+        self.ensure_loaded()
+        if self.font_buffer is not None:
+            page.insert_font(fontname=self.font_name, fontbuffer=self.font_buffer)
+        return self.font_name
+
+
+_registry = FontRegistry(FONT_PATHS)
+
+
+def get_font_registry() -> FontRegistry:
+    """Returns the process-wide font registry, loading the font on first use."""
+    return _registry.ensure_loaded()
+
+
+def subset_fonts(doc: fitz.Document):
+    """
+    Subsets embedded fonts to the glyphs actually used in the document.
+    Must be called right before saving.
+    """
+    try:
+        doc.subset_fonts()
+    except Exception as e:
+        print(f"Error subsetting fonts: {e}")
+
+
+def _font_dict_owner(doc: fitz.Document, page_xref: int) -> tuple:
+    """
+    The object and key path holding a page's /Font dictionary. Resources and
+    Font may each be indirect; keys must be set on the object that owns them.
+    """
+    owner, path = page_xref, "Resources"
+    kind, value = doc.xref_get_key(owner, path)
+    if kind == "xref":
+        owner, path = int(value.split()[0]), ""
+    path = f"{path}/Font" if path else "Font"
+    kind, value = doc.xref_get_key(owner, path)
+    if kind == "xref":
+        owner, path = int(value.split()[0]), ""
+    return owner, path
+
+
+def _empty_font(doc: fitz.Document, font_xref: int):
+    """Empties a font copy that no page uses any more (program, widths, ToUnicode)."""
+    parts = []
+    kind, value = doc.xref_get_key(font_xref, "ToUnicode")
+    if kind == "xref":
+        parts.append(int(value.split()[0]))
+    kind, value = doc.xref_get_key(font_xref, "DescendantFonts")
+    if kind in ("array", "xref"):
+        descendant = int(value.strip("[]").split()[0])
+        for key in ("W", "FontDescriptor/FontFile2"):
+            kind, value = doc.xref_get_key(descendant, key)
+            if kind == "xref":
+                parts.append(int(value.split()[0]))
+    for xref in parts:
+        if doc.xref_is_stream(xref):
+            doc.update_stream(xref, b" ")
+        else:
+            doc.update_object(xref, "[]")
+
+
+class FontMerger:
+    """
+    Points every page of a document at one copy of the registry font.
+    Pages concatenated from separately saved fragments each bring their own
+    full copy of it; once merged, subset_fonts() subsets a single font for
+    the whole document. merge() can run after every insert, so the copies
+    are dropped while the document grows.
+    """
+
+    def __init__(self, doc: fitz.Document):
+        self.doc = doc
+        self.font_xref: Optional[int] = None
+
+    def merge(self, first_page: int = 0) -> int:
+        """Merges the pages from `first_page` on; returns the number of copies dropped."""
+        registry = get_font_registry()
+        if registry.font_buffer is None:
+            return 0
+        dropped = set()
+        for pno in range(first_page, self.doc.page_count):
+            page = self.doc[pno]
+            for xref, _, font_type, base_font, name, *_ in page.get_fonts(full=True):
+                # Subset copies ("ABCDEF+Name") are already final; leave them alone
+                if name != registry.font_name or font_type != "Type0" or "+" in base_font:
+                    continue
+                if self.font_xref is None:
+                    self.font_xref = xref
+                if xref == self.font_xref:
+                    continue
+                owner, path = _font_dict_owner(self.doc, page.xref)
+                self.doc.xref_set_key(owner, f"{path}/{name}" if path else name, f"{self.font_xref} 0 R")
+                dropped.add(xref)
+        for xref in dropped:
+            _empty_font(self.doc, xref)
+        return len(dropped)
+
+
+def merge_fonts(doc: fitz.Document) -> int:
+    """FontMerger.merge() over a whole document."""
+    return FontMerger(doc).merge()
@@ -0,0 +1,299 @@
+import fitz
+import os
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image
+
+from . import fonts, images, pdf_service, render_cache, render_timing
+
+
+# Attachment fragments built at upload time are stored next to the original file
+STORED_FRAGMENT_SUFFIX = ".fragment.pdf"
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
+
+
+class AttachmentRejected(Exception):
+    """An uploaded attachment that cannot be rendered; the message is shown to the user."""
+
+
+def stored_fragment_path(file_path: str) -> str:
+    return f"{file_path}{STORED_FRAGMENT_SUFFIX}"
+
+
+def _fragment_bytes(doc: fitz.Document, key: Optional[str] = None) -> bytes:
+    # Fonts stay unsubset: the assembled document merges every fragment's copy
+    # into one font and subsets it once (fonts.merge_fonts)
+    if key:
+        # Lets a stored fragment be checked against the attachment it was built for
+        doc.set_metadata({"keywords": key})
+    with render_timing.stage("fragment_save"):
+        return doc.tobytes(deflate=True)
+
+
+def render_form_fragment(template_path: str, data: dict, photo_path: Optional[str] = None) -> bytes:
+    """The filled form page on its own, as PDF bytes."""
+    doc = pdf_service.render_form(template_path, data, photo_path)
+    try:
+        return _fragment_bytes(doc)
+    finally:
+        doc.close()
+
+
+def render_form_preview(template_path: str, data: dict, photo_path: Optional[str], dpi: int,
+                        image_format: str) -> bytes:
+    """
+    Page one of the volunteer's PDF as an image, rasterized from the form
+    fragment alone (cached like in render_pdf_timed); attachments are not needed.
+    """
+    cache = render_cache.get_fragment_cache()
+    key = render_cache.form_fragment_key(template_path, data, photo_path)
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render_form_fragment(template_path, data, photo_path)
+        cache.put(key, fragment)
+    return pdf_service.render_preview(fragment, dpi, image_format)
+
+
+def render_overlay_fragment(template_path: str, data: dict, photo_path: Optional[str] = None) -> bytes:
+    """The form page's field values and photo without the template background, as PDF bytes."""
+    doc = pdf_service.render_form_overlay(template_path, data, photo_path)
+    try:
+        return _fragment_bytes(doc)
+    finally:
+        doc.close()
+
+
+def render_attachment_fragment(attachment: dict, key: Optional[str] = None) -> Optional[bytes]:
+    """One attachment's title and content pages, or None if it adds no pages."""
+    doc = fitz.open()
+    try:
+        pdf_service.add_attachment_pages(doc, [attachment])
+        if doc.page_count == 0:
+            return None
+        return _fragment_bytes(doc, key)
+    finally:
+        doc.close()
+
+
+def read_stored_fragment(attachment: dict, key: str) -> Optional[bytes]:
+    """
+    The fragment built at upload time, if there is one and it is still current.
+    Its local path is given as attachment["fragment_path"] (see main.get_attachments_for_pdf).
+    """
+    fragment_path = attachment.get("fragment_path")
+    if not fragment_path:
+        return None
+    try:
+        with open(fragment_path, "rb") as f:
+            data = f.read()
+        with fitz.open("pdf", data) as doc:
+            # Older renderer or image settings, or a renamed attachment
+            if doc.metadata.get("keywords") != key:
+                return None
+        return data
+    except Exception:
+        return None
+
+
+def _validate_attachment(file_path: str) -> int:
+    """
+    Checks that an uploaded file can be rendered and returns its page count.
+    Damaged PDFs that MuPDF can repair are rewritten in repaired form.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".pdf":
+        try:
+            doc = fitz.open(file_path)
+        except Exception as e:
+            print(f"[FRAGMENTS] Rejected PDF {file_path}: {e}")
+            raise AttachmentRejected("ملف PDF تالف ولا يمكن فتحه")
+        try:
+            if doc.needs_pass:
+                raise AttachmentRejected("ملف PDF محمي بكلمة مرور")
+            if doc.page_count == 0:
+                raise AttachmentRejected("ملف PDF لا يحتوي على صفحات")
+            if doc.is_repaired:
+                # Saved clean once, so renders do not repair it again every time
+                repaired = doc.tobytes(garbage=3, deflate=True)
+                pdf_service.write_pdf(file_path, repaired)
+                print(f"[FRAGMENTS] Repaired PDF {file_path}")
+            return doc.page_count
+        finally:
+            doc.close()
+    if ext in IMAGE_EXTENSIONS:
+        try:
+            with Image.open(file_path) as img:
+                if img.size[0] * img.size[1] > images.MAX_IMAGE_PIXELS:
+                    # Checked without decoding; renders downsample it or show a notice
+                    img.verify()
+                else:
+                    img.load()
+        except Image.DecompressionBombError:
+            raise AttachmentRejected("أبعاد الصورة كبيرة جداً")
+        except Exception as e:
+            print(f"[FRAGMENTS] Rejected image {file_path}: {e}")
+            raise AttachmentRejected("الصورة تالفة أو بصيغة غير مدعومة")
+        return 1
+    raise AttachmentRejected("نوع الملف غير مدعوم. المسموح: صور و PDF")
+
+
+def prepare_attachment(file_path: str, name: str, fragment_path: str = None) -> int:
+    """
+    Upload-time processing of a new attachment: validates (and if needed
+    repairs) the file, then builds its fragment (title page plus content)
+    and writes it to `fragment_path` (next to the file by default), to be
+    stored with the original so renders only have to insert it.
+    Returns the number of pages the attachment adds, title page included.
+    Raises AttachmentRejected for files that cannot be rendered.
+    """
+    content_pages = _validate_attachment(file_path)
+    if content_pages > pdf_service.MAX_ATTACHMENT_PAGES:
+        # Truncated with a notice page at render time (see add_attachment_pages)
+        content_pages = pdf_service.MAX_ATTACHMENT_PAGES + 1
+    attachment = {"name": name, "file_path": file_path}
+    key = render_cache.attachment_fragment_key(attachment)
+    if key is None:
+        raise AttachmentRejected("الملف فارغ")
+    fragment = render_attachment_fragment(attachment, key)
+    pages = 0
+    if fragment:
+        with fitz.open("pdf", fragment) as doc:
+            pages = doc.page_count
+    # Title page plus content for a PDF, a single page for an image
+    expected = content_pages + 1 if file_path.lower().endswith(".pdf") else 1
+    if pages != expected:
+        raise AttachmentRejected("تعذرت معالجة الملف")
+    pdf_service.write_pdf(fragment_path or stored_fragment_path(file_path), fragment)
+    render_cache.get_fragment_cache().put(key, fragment)
+    print(f"[FRAGMENTS] Prepared {file_path}: {pages} page(s), {len(fragment)} bytes")
+    return pages
+
+
+def _load_attachment_fragment(attachment: dict, key: str) -> Optional[bytes]:
+    # Uploaded after upload-time processing existed: the stored fragment is ready to insert
+    with render_timing.stage("fragment_stored"):
+        fragment = read_stored_fragment(attachment, key)
+    if fragment is not None:
+        return fragment
+    return render_attachment_fragment(attachment)
+
+
+def render_pdf_timed(template_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None,
+                     save_profile: str = None) -> Tuple[bytes, Optional[dict]]:
+    """
+    Same output as pdf_service.render_pdf_timed, assembled from cached fragments:
+    the form page (keyed by text fields and photo) and one fragment per
+    attachment (keyed by title and content). Only fragments whose inputs
+    changed are rendered; the rest are read back and concatenated, so adding
+    a document to a volunteer with many scans costs one attachment, not all.
+    Attachment fragments stored at upload time (prepare_attachment) are used
+    before rendering from the original file.
+    """
+    attachments = attachments or []
+    timer = render_timing.begin(
+        profile=save_profile or pdf_service.DEFAULT_SAVE_PROFILE,
+        fields=sum(1 for value in data.values() if value),
+        photo=bool(photo_path),
+        attachment_count=len(attachments),
+    )
+    cache = render_cache.get_fragment_cache()
+    # Shared by all attachments; fragments over budget are left out of this
+    # render only (with a notice page), never cached that way
+    budget = pdf_service.RenderBudget()
+    reused = rendered = omitted = 0
+    doc = fitz.open()
+    try:
+        # (key, build, attachment or None for the form page)
+        parts: List[Tuple[str, Callable[[], Optional[bytes]], Optional[dict]]] = [(
+            render_cache.form_fragment_key(template_path, data, photo_path),
+            lambda: render_form_fragment(template_path, data, photo_path),
+            None,
+        )]
+        for attachment in attachments:
+            key = render_cache.attachment_fragment_key(attachment)
+            if key is None:
+                print(f"Attachment not found or empty: {attachment.get('file_path', '')}")
+                continue
+            parts.append((key, lambda attachment=attachment, key=key: _load_attachment_fragment(attachment, key),
+                          attachment))
+
+        for key, build, attachment in parts:
+            with render_timing.stage("fragment_read"):
+                fragment = cache.get(key)
+            if attachment is not None:
+                size = len(fragment) if fragment is not None else os.path.getsize(attachment["file_path"])
+                if not budget.charge(size):
+                    print(f"Render memory budget spent, leaving out {attachment['file_path']}")
+                    pdf_service.add_budget_notice(doc, attachment.get("name", "مرفق"))
+                    omitted += 1
+                    continue
+            if fragment is None:
+                fragment = build()
+                rendered += 1
+                if fragment is None:
+                    continue
+                cache.put(key, fragment)
+            else:
+                reused += 1
+            with render_timing.stage("concatenate"):
+                with fitz.open("pdf", fragment) as part:
+                    doc.insert_pdf(part)
+
+        with render_timing.stage("font_subset"):
+            fonts.merge_fonts(doc)
+            fonts.subset_fonts(doc)
+        pdf_bytes = pdf_service.save_document(doc, save_profile)
+    except Exception as e:
+        render_timing.end(timer, error=str(e))
+        raise
+    finally:
+        doc.close()
+    print(f"[FRAGMENTS] {reused} reused, {rendered} rendered, {omitted} over budget")
+    return pdf_bytes, render_timing.end(timer, bytes=len(pdf_bytes), fragments_reused=reused,
+                                        fragments_rendered=rendered, fragments_omitted=omitted)
+
+
+def render_pdf(template_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None,
+               save_profile: str = None) -> bytes:
+    pdf_bytes, _ = render_pdf_timed(template_path, data, photo_path, attachments, save_profile)
+    return pdf_bytes
+
+
+def render_batch_parts(template_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None
+                       ) -> Tuple[bytes, List[Tuple[str, Optional[bytes]]]]:
+    """
+    One volunteer's share of a bulk print document (pdf_service.BatchDocument):
+    the form overlay and the attachment fragments, as (name, fragment), read
+    from the fragment cache or rendered here, so the assembler only has to
+    insert them. Attachments past this volunteer's own render budget come back
+    as (name, None) and get a notice page.
+    """
+    cache = render_cache.get_fragment_cache()
+    key = render_cache.form_fragment_key(template_path, data, photo_path, overlay=True)
+    overlay = cache.get(key)
+    if overlay is None:
+        overlay = render_overlay_fragment(template_path, data, photo_path)
+        cache.put(key, overlay)
+
+    budget = pdf_service.RenderBudget()
+    parts = []
+    for attachment in attachments or []:
+        name = attachment.get("name", "مرفق")
+        key = render_cache.attachment_fragment_key(attachment)
+        if key is None:
+            print(f"Attachment not found or empty: {attachment.get('file_path', '')}")
+            continue
+        fragment = cache.get(key)
+        size = len(fragment) if fragment is not None else os.path.getsize(attachment["file_path"])
+        if not budget.charge(size):
+            print(f"Render memory budget spent, leaving out {attachment['file_path']}")
+            parts.append((name, None))
+            continue
+        if fragment is None:
+            fragment = _load_attachment_fragment(attachment, key)
+            if fragment is None:
+                continue
+            cache.put(key, fragment)
+        parts.append((name, fragment))
+    return overlay, parts
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple
+
+import fitz
+from PIL import Image, ImageOps
+
+
+# Target resolution for the photo box on the form page
+PHOTO_DPI = int(os.environ.get("PHOTO_DPI", "200"))
+PHOTO_JPEG_QUALITY = int(os.environ.get("PHOTO_JPEG_QUALITY", "85"))
+
+# Target resolution for image attachments on their A4 page
+ATTACHMENT_DPI = int(os.environ.get("ATTACHMENT_DPI", "150"))
+ATTACHMENT_JPEG_QUALITY = int(os.environ.get("ATTACHMENT_JPEG_QUALITY", "80"))
+
+# Largest image decoded during a render, in pixels after JPEG draft scaling.
+# Bounds the memory of one decode; larger images get a notice page instead.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(40 * 1000 * 1000)))
+
+# On-demand thumbnails of uploaded images for the edit and list pages (see main.thumbnail)
+THUMBNAIL_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp")
+THUMBNAIL_MAX_WIDTH = int(os.environ.get("THUMBNAIL_MAX_WIDTH", "800"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "75"))
+
+# Files whose content hash is remembered, most recently used kept
+_HASH_INDEX_SIZE = 10000
+
+# (path, size, mtime) -> content hash, so unchanged files are not re-read to hash them
+_hash_index: "OrderedDict[Tuple[str, int, float], str]" = OrderedDict()
+_hash_index_lock = threading.Lock()
+
+
+def _remember_hash(key: Tuple[str, int, float], digest: str):
+    with _hash_index_lock:
+        _hash_index[key] = digest
+        _hash_index.move_to_end(key)
+        while len(_hash_index) > _HASH_INDEX_SIZE:
+            _hash_index.popitem(last=False)
+
+
+def content_hash(path: str) -> str:
+    """SHA256 of a file's content, remembered per (path, size, mtime)."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    with _hash_index_lock:
+        digest = _hash_index.get(key)
+        if digest is not None:
+            _hash_index.move_to_end(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _remember_hash(key, digest)
+    return digest
+
+
+class ImageTooLarge(Exception):
+    """An image with more pixels than MAX_IMAGE_PIXELS even after draft scaling."""
+
+    def __init__(self, pixels: Optional[int]):
+        super().__init__(f"Image has {pixels or 'too many'} pixels, limit is {MAX_IMAGE_PIXELS}")
+        self.pixels = pixels
+
+
+def remember_content_hash(path: str, digest: str):
+    """Records a hash computed elsewhere (e.g. while an upload was received)."""
+    st = os.stat(path)
+    _remember_hash((os.path.abspath(path), st.st_size, st.st_mtime), digest)
+
+
+def _derived_cache():
+    # Imported here: render_cache imports this module for content_hash
+    from . import render_cache
+    return render_cache.get_derived_cache()
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """Converts to RGB, flattening transparency onto white instead of black."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def _encode_fitted(image_path: str, max_width: int, max_height: int, quality: int,
+                   image_format: str = "JPEG") -> Tuple[bytes, Tuple[int, int]]:
+    """
+    Decodes an image once, applies EXIF orientation, fits it in the box and
+    encodes JPEG (or `image_format`). Returns the bytes and the resulting pixel size.
+    """
+    try:
+        img = Image.open(image_path)
+    except Image.DecompressionBombError:
+        # Pillow's own guard (far above ours) refuses to even open it
+        raise ImageTooLarge(None)
+    with img:
+        # Let the JPEG decoder skip detail we are about to throw away
+        img.draft("RGB", (max_width, max_height))
+        pixels = img.size[0] * img.size[1]
+        if pixels > MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(pixels)
+        img = ImageOps.exif_transpose(img)
+        img = _to_rgb(img)
+        img.thumbnail((max_width, max_height), Image.LANCZOS)
+        buf = BytesIO()
+        img.save(buf, format=image_format, quality=quality, optimize=True)
+        return buf.getvalue(), img.size
+
+
+def prepare_photo(photo_path: str, rect: fitz.Rect, dpi: int = None, quality: int = None) -> bytes:
+    """
+    Returns JPEG bytes for the photo, downsampled to `dpi` for the given rect.
+    The result is cached on local disk (render_cache.get_derived_cache) keyed by
+    the photo's content hash.
+    """
+    dpi = dpi or PHOTO_DPI
+    quality = quality or PHOTO_JPEG_QUALITY
+    max_width = max(1, int(round(rect.width / 72 * dpi)))
+    max_height = max(1, int(round(rect.height / 72 * dpi)))
+
+    digest = content_hash(photo_path)
+    cache = _derived_cache()
+    key = f"photo_{digest}_{max_width}x{max_height}_q{quality}"
+    data = cache.get(key)
+    if data is None:
+        data, _ = _encode_fitted(photo_path, max_width, max_height, quality)
+        cache.put(key, data)
+        print(f"Prepared photo {photo_path}: {os.path.getsize(photo_path)} -> {len(data)} bytes")
+    return data
+
+
+def render_thumbnail(image_path: str, width: int, image_format: str = None) -> bytes:
+    """
+    A small WebP or JPEG copy of an uploaded image, at most `width` pixels wide
+    (and four times that tall), never upscaled. Raises ImageTooLarge like renders do.
+    """
+    image_format = image_format or THUMBNAIL_FORMAT
+    data, _ = _encode_fitted(image_path, width, width * 4, THUMBNAIL_QUALITY, image_format.upper())
+    return data
+
+
+def prepare_attachment_image(image_path: str, box_width: float, box_height: float,
+                             dpi: int = None, quality: int = None) -> Tuple[bytes, Tuple[int, int]]:
+    """
+    Returns (JPEG bytes, pixel size) for an image attachment fitted to a box
+    given in points at `dpi`. Cached on local disk by content hash, so repeated
+    renders of the same volunteer reuse the derived bytes.
+    """
+    dpi = dpi or ATTACHMENT_DPI
+    quality = quality or ATTACHMENT_JPEG_QUALITY
+    max_width = max(1, int(round(box_width / 72 * dpi)))
+    max_height = max(1, int(round(box_height / 72 * dpi)))
+
+    digest = content_hash(image_path)
+    cache = _derived_cache()
+    key = f"attachment_{digest}_{max_width}x{max_height}_q{quality}"
+    data = cache.get(key)
+    if data is None:
+        data, size = _encode_fitted(image_path, max_width, max_height, quality)
+        cache.put(key, data)
+        print(f"Prepared attachment image {image_path}: {len(data)} bytes at {size[0]}x{size[1]}")
+        return data, size
+
+    # Only the header is parsed to get the size of a cached derivative
+    with Image.open(BytesIO(data)) as img:
+        return data, img.size
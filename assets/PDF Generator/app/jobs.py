@@ -0,0 +1,275 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import and_, or_
+
+from . import database, models
+
+
+# Finished results live next to the database so they survive restarts too
+DATA_DIR = os.environ.get("DATA_DIR", ".")
+JOB_RESULTS_DIR = os.environ.get("JOB_RESULTS_DIR", os.path.join(DATA_DIR, "job_results"))
+# Jobs run at the same time on this instance
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# A running job is owned by its instance until the lease expires; a heartbeat
+# renews it every third of the lease while the handler runs
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "120"))
+# How often idle workers look for jobs submitted to other instances or due for retry
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "5"))
+JOB_RETRY_BACKOFF_SECONDS = float(os.environ.get("JOB_RETRY_BACKOFF_SECONDS", "10"))
+# Finished and failed jobs (and their result files) are removed after this long
+JOB_RESULT_TTL_SECONDS = float(os.environ.get("JOB_RESULT_TTL_HOURS", "24")) * 3600
+
+# params, output file, progress(done, total) -> (result filename, media type)
+JobHandler = Callable[[dict, BinaryIO, Callable[[int, int], None]], Tuple[str, str]]
+
+
+class JobFailed(Exception):
+    """Raised by a handler for errors a retry cannot fix (e.g. volunteer deleted)."""
+
+
+def job_to_dict(job: models.PdfJob) -> dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.error,
+        "progress": {"done": job.progress_done, "total": job.progress_total},
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+        "result_name": job.result_name if job.status == "done" else None,
+    }
+
+
+class JobRunner:
+    """
+    Runs PdfJob rows on background threads with bounded concurrency.
+    Jobs are claimed with a conditional UPDATE, so several instances sharing
+    the database never run the same job twice. A job left running by an
+    instance that was stopped is picked up again once its lease expires,
+    and failures are retried with backoff up to max_attempts.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = max(1, workers)
+        self.handlers: Dict[str, JobHandler] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_cleanup = 0.0
+
+    def register(self, kind: str, handler: JobHandler):
+        self.handlers[kind] = handler
+
+    def submit(self, db, kind: str, params: dict, total: int = 0) -> models.PdfJob:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = time.time()
+        job = models.PdfJob(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            params=json.dumps(params, ensure_ascii=False),
+            status="queued",
+            attempts=0,
+            max_attempts=JOB_MAX_ATTEMPTS,
+            created_at=now,
+            updated_at=now,
+            run_after=0,
+            progress_total=total,
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        self._wake.set()
+        return job
+
+    def start(self):
+        if self._threads:
+            return
+        os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"pdf-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"[JOBS] {self.workers} job worker(s) started")
+
+    def stop(self):
+        """Stops taking new jobs; a job still running is retried elsewhere after its lease."""
+        self._stop.set()
+        self._wake.set()
+        self._threads = []
+
+    # ---------- claiming ----------
+
+    @staticmethod
+    def _claimable(now: float):
+        return or_(
+            and_(models.PdfJob.status == "queued", models.PdfJob.run_after <= now),
+            and_(models.PdfJob.status == "running", models.PdfJob.lease_until < now),
+        )
+
+    def _claim(self) -> Optional[str]:
+        db = database.SessionLocal()
+        try:
+            now = time.time()
+            candidates = db.query(models.PdfJob.id).filter(self._claimable(now)) \
+                .order_by(models.PdfJob.created_at).limit(self.workers * 2).all()
+            for (job_id,) in candidates:
+                claimed = db.query(models.PdfJob).filter(models.PdfJob.id == job_id, self._claimable(now)).update({
+                    models.PdfJob.status: "running",
+                    models.PdfJob.attempts: models.PdfJob.attempts + 1,
+                    models.PdfJob.lease_until: now + JOB_LEASE_SECONDS,
+                    models.PdfJob.updated_at: now,
+                }, synchronize_session=False)
+                db.commit()
+                if claimed != 1:
+                    continue  # another worker or instance got it first
+                job = db.query(models.PdfJob).filter(models.PdfJob.id == job_id).first()
+                if job.attempts > job.max_attempts:
+                    # It kept dying mid-run (e.g. out of memory or restarts); stop trying
+                    self._finish(job_id, "failed", error=job.error or f"Gave up after {job.max_attempts} attempts")
+                    continue
+                return job_id
+            return None
+        finally:
+            db.close()
+
+    # ---------- running ----------
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._cleanup()
+                job_id = self._claim()
+            except Exception as e:
+                print(f"[JOBS] Error claiming a job: {e}")
+                job_id = None
+            if job_id is None:
+                self._wake.wait(JOB_POLL_SECONDS)
+                self._wake.clear()
+                continue
+            self._execute(job_id)
+
+    def _execute(self, job_id: str):
+        db = database.SessionLocal()
+        try:
+            job = db.query(models.PdfJob).filter(models.PdfJob.id == job_id).first()
+            kind, params, attempt, max_attempts = job.kind, json.loads(job.params), job.attempts, job.max_attempts
+        finally:
+            db.close()
+
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self._finish(job_id, "failed", error=f"Unknown job kind: {kind}")
+            return
+
+        print(f"[JOBS] {job_id} {kind} started (attempt {attempt})")
+        start = time.perf_counter()
+        last_update = [0.0]
+
+        def progress(done: int, total: int):
+            # Throttled to keep database writes down
+            now = time.time()
+            if now - last_update[0] < 1 and done < total:
+                return
+            last_update[0] = now
+            self._update(job_id, progress_done=done, progress_total=total)
+
+        # Built on local disk, then moved next to the database in one go
+        temp_path = os.path.join(tempfile.gettempdir(), f"vms_job_{job_id}.{uuid.uuid4().hex}.tmp")
+        try:
+            # A handler may go minutes without reporting progress (one large volunteer)
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, heartbeat_stop),
+                                         name=f"pdf-job-lease-{job_id[:8]}", daemon=True)
+            heartbeat.start()
+            try:
+                with open(temp_path, "wb") as out:
+                    result_name, media_type = handler(params, out, progress)
+            finally:
+                # Stopped before the job is finished, so it cannot renew a released lease
+                heartbeat_stop.set()
+                heartbeat.join()
+            result_path = os.path.join(JOB_RESULTS_DIR, f"{job_id}{os.path.splitext(result_name)[1]}")
+            os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+            shutil.move(temp_path, result_path)
+            self._finish(job_id, "done", result_path=result_path, result_name=result_name,
+                         result_media_type=media_type)
+            print(f"[JOBS] {job_id} done in {(time.perf_counter() - start) * 1000:.0f}ms")
+        except Exception as e:
+            if isinstance(e, JobFailed) or attempt >= max_attempts:
+                self._finish(job_id, "failed", error=str(e))
+                print(f"[JOBS] {job_id} failed: {e}")
+            else:
+                self._update(job_id, status="queued", error=str(e), lease_until=None,
+                             run_after=time.time() + JOB_RETRY_BACKOFF_SECONDS * attempt)
+                print(f"[JOBS] {job_id} attempt {attempt} failed, will retry: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _heartbeat(self, job_id: str, stop: threading.Event):
+        """Renews the lease of a running job until `stop` is set."""
+        while not stop.wait(JOB_LEASE_SECONDS / 3):
+            db = database.SessionLocal()
+            try:
+                now = time.time()
+                db.query(models.PdfJob).filter(
+                    models.PdfJob.id == job_id, models.PdfJob.status == "running"
+                ).update({models.PdfJob.lease_until: now + JOB_LEASE_SECONDS, models.PdfJob.updated_at: now},
+                         synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                # The next beat tries again; the lease only lapses if they keep failing
+                print(f"[JOBS] {job_id} lease renewal failed: {e}")
+            finally:
+                db.close()
+
+    def _update(self, job_id: str, **values):
+        db = database.SessionLocal()
+        try:
+            values["updated_at"] = time.time()
+            db.query(models.PdfJob).filter(models.PdfJob.id == job_id).update(
+                {getattr(models.PdfJob, k): v for k, v in values.items()}, synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _finish(self, job_id: str, status: str, **values):
+        self._update(job_id, status=status, lease_until=None, **values)
+
+    def _cleanup(self):
+        """Removes expired jobs and their result files, at most once an hour."""
+        now = time.time()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        db = database.SessionLocal()
+        try:
+            expired = db.query(models.PdfJob).filter(
+                models.PdfJob.status.in_(["done", "failed"]),
+                models.PdfJob.updated_at < now - JOB_RESULT_TTL_SECONDS,
+            ).all()
+            for job in expired:
+                if job.result_path and os.path.exists(job.result_path):
+                    try:
+                        os.remove(job.result_path)
+                    except OSError as e:
+                        print(f"[JOBS] Could not remove {job.result_path}: {e}")
+                db.delete(job)
+            db.commit()
+            if expired:
+                print(f"[JOBS] Removed {len(expired)} expired job(s)")
+        finally:
+            db.close()
@@ -1,24 +1,28 @@
 from fastapi import FastAPI, Request, Depends, Form, UploadFile, File, HTTPException
 from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse, Response, StreamingResponse
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
 from starlette.middleware.sessions import SessionMiddleware
+from pydantic import BaseModel
 import hashlib
-import shutil
 import os
 import pandas as pd
-from typing import Optional, List
+from typing import Optional
 import uuid
-import base64
 import qrcode
 from io import BytesIO
 import json
-import zipfile
+from urllib.parse import quote
 
-from . import models, database, pdf_service
+from . import models, database, pdf_service, render_cache, render_queue, render_timing, bulk_export, zip_stream, jobs, fragments, uploads, storage, images
+# PDF rendering outside a request lives in volunteer_pdf, so the bulk export CLI can use it without main
+from .volunteer_pdf import (
+    PDF_TEMPLATE_PATH, PDF_SAVE_PROFILE, ZIP_SAVE_PROFILE, pdf_render_pool, volunteer_prefix, resolve_upload,
+    get_pdf_inputs, get_pdf_render_key, load_cached_pdf, store_rendered_pdf, get_or_render_pdf,
+    render_volunteer_pdf, render_many_volunteers, render_volunteer_batch
+)
 
 # Password hashing using SHA256 (simple and reliable)
 def verify_password(plain_password, hashed_password):
@@ -27,10 +31,13 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-# Use DATA_DIR from environment for persistent storage (Cloud Storage mount)
-DATA_DIR = os.environ.get("DATA_DIR", ".")
-UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
-os.makedirs(UPLOADS_DIR, exist_ok=True)
+# Uploads live under DATA_DIR/uploads (Cloud Storage mount) and are accessed through
+# the storage layer: cached metadata, local read cache and write-back (see storage.py)
+UPLOADS_DIR = storage.UPLOADS_DIR
+file_store = storage.get_storage()
+# Photos and attachments get UUID names and never change once written, so browsers may keep them
+IMMUTABLE_UPLOAD_PREFIXES = ("photo_", "attachment_")
+UPLOAD_CACHE_CONTROL = os.environ.get("UPLOAD_CACHE_CONTROL", "private, max-age=31536000, immutable")
 
 # Create DB tables
 models.Base.metadata.create_all(bind=database.engine)
@@ -70,8 +77,42 @@ app.add_middleware(
 # Add session middleware (secret key for signing cookies)
 app.add_middleware(SessionMiddleware, secret_key="volunteer-pdf-generator-secret-key-2024")
 
-# Mount static files - serve from persistent storage
-app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
+def upload_version(key: str):
+    """
+    (version, Cache-Control, local path or None) of a stored file; 404 if there is none.
+    Photos and attachments never change, so their version comes from the name and
+    the indexed size without reading the file. Anything else (the folder's PDF copy
+    is rewritten by renders) is fetched and versioned by content.
+    """
+    try:
+        size = file_store.size(key)
+    except ValueError:
+        size = None
+    if size is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    if os.path.basename(key).startswith(IMMUTABLE_UPLOAD_PREFIXES):
+        return hashlib.sha256(f"{key}\n{size}".encode("utf-8")).hexdigest(), UPLOAD_CACHE_CONTROL, None
+    local_path = file_store.local_path(key)
+    if not local_path:
+        raise HTTPException(status_code=404, detail="Not found")
+    return images.content_hash(local_path), "private, no-cache", local_path
+
+@app.api_route("/uploads/{key:path}", methods=["GET", "HEAD"])
+def serve_upload(key: str, request: Request):
+    """
+    Uploaded files, read through the local storage cache. Photos and attachments
+    are cached by the browser for good, and If-None-Match on them is answered
+    without reading the file. Range and If-Range requests are handled by FileResponse.
+    """
+    version, cache_control, local_path = upload_version(key)
+    headers = {"ETag": render_cache.etag_for(version), "Cache-Control": cache_control}
+    if render_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    local_path = local_path or file_store.local_path(key)
+    if not local_path:
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(local_path, headers=headers)
 
 templates = Jinja2Templates(directory="app/templates")
 
@@ -102,99 +143,183 @@ def require_admin(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
-PDF_TEMPLATE_PATH = "assets/الاستمارة الجديدة الدائمية.pdf"
+@app.get("/thumb/{key:path}")
+async def thumbnail(key: str, request: Request, w: Optional[int] = None, format: Optional[str] = None,
+                    db: Session = Depends(get_db)):
+    """
+    A small WebP/JPEG copy of an uploaded image for the edit and list pages,
+    made on first request and kept in a size-bounded local cache. Cached by
+    the browser like the original.
+    """
+    user = await run_in_threadpool(get_current_user, request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    image_format = (format or images.THUMBNAIL_FORMAT).lower()
+    if image_format not in images.THUMBNAIL_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be webp or jpeg")
+    if os.path.splitext(key)[1].lower() not in fragments.IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Not an image")
+    width = max(16, min(w or 200, images.THUMBNAIL_MAX_WIDTH))
+    
+    version, cache_control, local_path = await run_in_threadpool(upload_version, key)
+    thumb_key = render_cache.thumbnail_key(version, width, image_format)
+    headers = {"ETag": render_cache.etag_for(thumb_key), "Cache-Control": cache_control}
+    if render_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    thumbnail_cache = render_cache.get_thumbnail_cache()
+    image = await run_in_threadpool(thumbnail_cache.get, thumb_key)
+    if image is None:
+        local_path = local_path or await run_in_threadpool(file_store.local_path, key)
+        if not local_path:
+            raise HTTPException(status_code=404, detail="Not found")
+        try:
+            image = await pdf_render_pool.thumbnail_async(local_path, width, image_format)
+        except Exception as e:
+            print(f"[THUMBNAIL] Could not make a thumbnail of {key}: {e}")
+            raise HTTPException(status_code=422, detail="Image cannot be read")
+        await run_in_threadpool(thumbnail_cache.put, thumb_key, image)
+    return Response(content=image, media_type=images.THUMBNAIL_FORMATS[image_format], headers=headers)
 
-def get_volunteer_folder(volunteer_id: int) -> str:
-    """Get or create volunteer-specific folder."""
-    folder = os.path.join(UPLOADS_DIR, f"volunteer_{volunteer_id}")
-    os.makedirs(folder, exist_ok=True)
-    return folder
+def content_disposition(filename: str, disposition: str = "attachment") -> str:
+    """Build a Content-Disposition header that survives Arabic filenames (RFC 5987)."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
 
-def save_image(file: UploadFile = None, base64_str: str = None, volunteer_id: int = None) -> Optional[str]:
+def delete_upload(path: Optional[str]):
+    if not path:
+        return
+    if os.path.isabs(path):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as e:
+                print(f"Error deleting file {path}: {e}")
+        return
+    file_store.delete(path)
+
+async def save_image(file: UploadFile = None, base64_str: str = None, volunteer_id: int = None) -> Optional[str]:
+    """
+    Save an uploaded or camera photo. Streamed through a local staging file
+    in chunks, then published in one sequential write (required for GCS FUSE).
+    """
     if not file and not base64_str:
         return None
     
     # Use volunteer-specific folder if volunteer_id is provided
-    if volunteer_id:
-        folder = get_volunteer_folder(volunteer_id)
-    else:
-        folder = UPLOADS_DIR
-    
     filename = f"photo_{uuid.uuid4()}.jpg"
-    filepath = os.path.join(folder, filename)
+    key = f"{volunteer_prefix(volunteer_id)}/{filename}" if volunteer_id else filename
     
     if file and file.filename:
-        # Read entire content first, then write in single operation (required for GCS FUSE)
-        content = file.file.read()
-        print(f"[SAVE_IMAGE] Read {len(content)} bytes from uploaded file: {file.filename}")
-        with open(filepath, "wb") as buffer:
-            buffer.write(content)
-        # Verify file was written
-        if os.path.exists(filepath):
-            actual_size = os.path.getsize(filepath)
-            print(f"[SAVE_IMAGE] Saved to {filepath}, file size: {actual_size} bytes")
-        else:
-            print(f"[SAVE_IMAGE] ERROR: File not found after write: {filepath}")
-        return os.path.relpath(filepath, UPLOADS_DIR).replace("\\", "/")
+        staged = await uploads.save_upload(file, key)
+        print(f"[SAVE_IMAGE] Saved {staged.size} bytes from uploaded file {file.filename} as {key}")
+        return key
     elif base64_str:
-        # Remove header if present (data:image/jpeg;base64,...)
-        if "base64," in base64_str:
-            base64_str = base64_str.split("base64,")[1]
-        
+        # data:image/jpeg;base64,... from the camera capture
         try:
-            img_data = base64.b64decode(base64_str)
-            print(f"[SAVE_IMAGE] Decoded {len(img_data)} bytes from base64")
-            with open(filepath, "wb") as f:
-                f.write(img_data)
-            # Verify file was written
-            if os.path.exists(filepath):
-                actual_size = os.path.getsize(filepath)
-                print(f"[SAVE_IMAGE] Saved to {filepath}, file size: {actual_size} bytes")
-            else:
-                print(f"[SAVE_IMAGE] ERROR: File not found after write: {filepath}")
-            return os.path.relpath(filepath, UPLOADS_DIR).replace("\\", "/")
-        except Exception as e:
+            staged = await uploads.stage_base64(base64_str)
+        except ValueError as e:
             print(f"[SAVE_IMAGE] ERROR decoding base64: {e}")
             return None
+        await staged.publish(key)
+        print(f"[SAVE_IMAGE] Saved {staged.size} bytes from base64 as {key}")
+        return key
     return None
 
-def save_attachment(file: UploadFile, volunteer_id: int) -> Optional[str]:
-    """Save an attachment file (image or PDF) to volunteer's folder."""
+async def save_attachment(file: UploadFile, volunteer_id: int, name: str) -> Optional[str]:
+    """
+    Save an attachment file (image or PDF) to volunteer's folder, streamed like save_image.
+    It is validated and its PDF fragment built while still staged on local disk, so
+    nothing reaches storage unless it can be rendered; the fragment is stored next to it.
+    Raises fragments.AttachmentRejected otherwise.
+    """
     if not file or not file.filename:
         return None
     
-    folder = get_volunteer_folder(volunteer_id)
     ext = os.path.splitext(file.filename)[1].lower()
-    filename = f"attachment_{uuid.uuid4()}{ext}"
-    filepath = os.path.join(folder, filename)
-    
-    # Read entire content first, then write in single operation (required for GCS FUSE)
-    content = file.file.read()
-    print(f"[SAVE_ATTACHMENT] Read {len(content)} bytes from uploaded file: {file.filename}")
-    with open(filepath, "wb") as buffer:
-        buffer.write(content)
-    
-    # Verify file was written
-    if os.path.exists(filepath):
-        actual_size = os.path.getsize(filepath)
-        print(f"[SAVE_ATTACHMENT] Saved to {filepath}, file size: {actual_size} bytes")
-    else:
-        print(f"[SAVE_ATTACHMENT] ERROR: File not found after write: {filepath}")
+    key = f"{volunteer_prefix(volunteer_id)}/attachment_{uuid.uuid4()}{ext}"
     
-    return os.path.relpath(filepath, UPLOADS_DIR).replace("\\", "/")
+    staged = await uploads.stage_file(file, ext)
+    fragment_path = fragments.stored_fragment_path(staged.path)
+    try:
+        await pdf_render_pool.prepare_attachment_async(staged.path, name, fragment_path)
+        await staged.publish(key)
+        await run_in_threadpool(file_store.write_file, fragments.stored_fragment_path(key), fragment_path)
+    except Exception:
+        await staged.discard()
+        if os.path.exists(fragment_path):
+            os.remove(fragment_path)
+        raise
+    print(f"[SAVE_ATTACHMENT] Saved {staged.size} bytes from uploaded file {file.filename} as {key}")
+    
+    return key
 
-def get_attachments_for_pdf(volunteer) -> List[dict]:
-    """Get list of attachments with name and file_path for PDF generation."""
-    attachments = []
-    for att in volunteer.attachment_list:
-        file_path = att.file_path
-        # Convert relative path to absolute for PDF generation
-        if file_path and not os.path.isabs(file_path):
-            file_path = os.path.join(UPLOADS_DIR, file_path)
-        attachments.append({"name": att.name, "file_path": file_path})
-    
-    print(f"Found {len(attachments)} attachments for volunteer {volunteer.id}: {attachments}")
-    return attachments
+async def get_or_render_pdf_async(inputs: dict, render_key: str, save_profile: str,
+                                  ensure_folder_copy: bool = False) -> bytes:
+    """Same as get_or_render_pdf, for async routes; file I/O runs in the threadpool."""
+    pdf_bytes = await run_in_threadpool(load_cached_pdf, inputs, render_key, ensure_folder_copy)
+    if pdf_bytes is None:
+        pdf_bytes = await pdf_render_pool.render_async(inputs["data"], inputs["photo_path"],
+                                                       inputs["attachments"], save_profile)
+        await run_in_threadpool(store_rendered_pdf, inputs, render_key, pdf_bytes)
+    return pdf_bytes
+
+def prerender_volunteer_pdf(volunteer_id: int):
+    """Background job: render the volunteer's PDF into the render cache."""
+    render_volunteer_pdf(volunteer_id, PDF_SAVE_PROFILE)
+
+# Any write to a volunteer or its attachments queues a debounced render
+pdf_render_queue = render_queue.RenderQueue(prerender_volunteer_pdf)
+
+def run_pdf_job(params: dict, out, progress) -> tuple:
+    """Job handler: one volunteer's PDF."""
+    rendered = render_volunteer_pdf(params["volunteer_id"], params.get("profile") or PDF_SAVE_PROFILE)
+    if rendered is None:
+        raise jobs.JobFailed("Volunteer not found")
+    filename, pdf_bytes = rendered
+    out.write(pdf_bytes)
+    progress(1, 1)
+    return filename, "application/pdf"
+
+def run_bulk_job(params: dict, out, progress) -> tuple:
+    """Job handler: bulk export of the volunteer IDs resolved at submit time."""
+    volunteer_ids = params["volunteer_ids"]
+    export_format = params.get("format", "zip")
+    export_progress = bulk_export.start_progress(len(volunteer_ids))
+    report = lambda p: progress(p.done, p.total)
+    if export_format == "zip":
+        chunks = bulk_export.iter_zip(render_many_volunteers(volunteer_ids, export_progress, 0, report))
+        media_type = "application/zip"
+    else:
+        chunks = render_volunteer_batch(volunteer_ids, export_progress, 0, report)
+        media_type = "application/pdf"
+    for chunk in chunks:
+        out.write(chunk)
+    return f"volunteers_{len(volunteer_ids)}.{export_format}", media_type
+
+# Durable render jobs, persisted in the database (see /jobs routes)
+pdf_jobs = jobs.JobRunner()
+pdf_jobs.register("pdf", run_pdf_job)
+pdf_jobs.register("bulk", run_bulk_job)
+
+@app.on_event("startup")
+def start_render_pool():
+    try:
+        pdf_render_pool.start()
+    except Exception as e:
+        print(f"Warning: Could not start render workers: {e}")
+    pdf_jobs.start()
+    file_store.start()
+
+@app.on_event("shutdown")
+def stop_render_pool():
+    pdf_jobs.stop()
+    pdf_render_pool.shutdown()
+    # Cloud Run allows 10 seconds after SIGTERM; what is left stays journaled in the cache
+    file_store.flush(timeout=storage.STORAGE_FLUSH_TIMEOUT_SECONDS)
 
 def migrate_volunteer_files(volunteer, db: Session):
     """Migrate existing photo to volunteer-specific folder."""
@@ -206,16 +331,15 @@ def migrate_volunteer_files(volunteer, db: Session):
         return
     
     # Check if already in volunteer folder
-    volunteer_folder = get_volunteer_folder(volunteer.id)
-    if volunteer_folder.replace("\\", "/") in old_path:
+    folder_prefix = volunteer_prefix(volunteer.id)
+    if folder_prefix in old_path.replace("\\", "/"):
         return
     
     # Move file to volunteer folder
-    filename = os.path.basename(old_path)
-    new_path = os.path.join(volunteer_folder, filename)
+    new_key = f"{folder_prefix}/{os.path.basename(old_path)}"
     try:
-        shutil.move(old_path, new_path)
-        volunteer.photo_path = os.path.relpath(new_path, UPLOADS_DIR).replace("\\", "/")
+        file_store.write_file(new_key, old_path)
+        volunteer.photo_path = new_key
         db.commit()
     except Exception as e:
         print(f"Error migrating file: {e}")
@@ -299,14 +423,7 @@ def read_root(request: Request, q: Optional[str] = None, db: Session = Depends(g
     
     query = db.query(models.Volunteer)
     if q:
-        query = query.filter(
-            or_(
-                models.Volunteer.text1.contains(q),
-                models.Volunteer.text3.contains(q),
-                models.Volunteer.text9.contains(q),
-                models.Volunteer.text10.contains(q)
-            )
-        )
+        query = query.filter(bulk_export.search_filter(q))
     volunteers = query.all()
     return templates.TemplateResponse("list.html", {"request": request, "volunteers": volunteers, "query": q or "", "current_user": user})
 
@@ -343,11 +460,12 @@ async def create_volunteer(
     
     # Handle Image with volunteer-specific folder
     camera_image = form_data.get("camera_image")
-    photo_path = save_image(file=photo, base64_str=camera_image, volunteer_id=db_volunteer.id)
+    photo_path = await save_image(file=photo, base64_str=camera_image, volunteer_id=db_volunteer.id)
     if photo_path:
         db_volunteer.photo_path = photo_path
         db.commit()
 
+    pdf_render_queue.schedule(db_volunteer.id)
     return RedirectResponse(url=f"/edit/{db_volunteer.id}", status_code=303)
 
 @app.get("/edit/{id}", response_class=HTMLResponse)
@@ -391,17 +509,14 @@ async def update_volunteer(
     
     # Handle Image with volunteer-specific folder
     camera_image = form_data.get("camera_image")
-    new_photo_path = save_image(file=photo, base64_str=camera_image, volunteer_id=volunteer.id)
+    new_photo_path = await save_image(file=photo, base64_str=camera_image, volunteer_id=volunteer.id)
     if new_photo_path:
         # Delete old photo if exists
-        if volunteer.photo_path and os.path.exists(volunteer.photo_path):
-            try:
-                os.remove(volunteer.photo_path)
-            except:
-                pass
+        delete_upload(volunteer.photo_path)
         volunteer.photo_path = new_photo_path
     
     db.commit()
+    pdf_render_queue.schedule(volunteer.id)
     return RedirectResponse(url=f"/edit/{id}", status_code=303)
 
 @app.post("/delete/{id}")
@@ -415,20 +530,17 @@ def delete_volunteer(request: Request, id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Not found")
     
     # Delete volunteer folder and all files
-    volunteer_folder = get_volunteer_folder(volunteer.id)
-    if os.path.exists(volunteer_folder):
-        try:
-            shutil.rmtree(volunteer_folder)
-        except Exception as e:
-            print(f"Error deleting volunteer folder: {e}")
+    folder_prefix = volunteer_prefix(volunteer.id)
+    try:
+        file_store.delete_prefix(folder_prefix)
+    except Exception as e:
+        print(f"Error deleting volunteer folder: {e}")
     
     # Also delete old-style photo if exists outside folder
-    if volunteer.photo_path and os.path.exists(volunteer.photo_path):
-        try:
-            os.remove(volunteer.photo_path)
-        except:
-            pass
+    if volunteer.photo_path and not volunteer.photo_path.startswith(folder_prefix + "/"):
+        delete_upload(volunteer.photo_path)
     
+    pdf_render_queue.cancel(volunteer.id)
     db.delete(volunteer)
     db.commit()
     return RedirectResponse(url="/", status_code=303)
@@ -466,8 +578,11 @@ async def upload_attachment(
     if ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="نوع الملف غير مدعوم. المسموح: صور و PDF")
     
-    # Save attachment file
-    attachment_path = save_attachment(attachment_file, volunteer.id)
+    # Save attachment file (validated and its PDF fragment pre-built, so renders only insert it)
+    try:
+        attachment_path = await save_attachment(attachment_file, volunteer.id, attachment_name)
+    except fragments.AttachmentRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if attachment_path:
         # Create new attachment record
         new_attachment = models.Attachment(
@@ -477,6 +592,7 @@ async def upload_attachment(
         )
         db.add(new_attachment)
         db.commit()
+        pdf_render_queue.schedule(volunteer.id)
     
     return RedirectResponse(url=f"/edit/{id}", status_code=303)
 
@@ -502,16 +618,17 @@ async def delete_attachment(
     ).first()
     
     if attachment:
-        # Delete file
-        if os.path.exists(attachment.file_path):
+        # Delete file and its upload-time fragment
+        for path in (attachment.file_path, fragments.stored_fragment_path(attachment.file_path)):
             try:
-                os.remove(attachment.file_path)
+                delete_upload(path)
             except Exception as e:
                 print(f"Error deleting attachment file: {e}")
         
         # Delete record
         db.delete(attachment)
         db.commit()
+        pdf_render_queue.schedule(volunteer.id)
     
     return RedirectResponse(url=f"/edit/{id}", status_code=303)
 
@@ -526,45 +643,44 @@ def download_folder(id: int, request: Request, db: Session = Depends(get_db)):
     if not volunteer:
         raise HTTPException(status_code=404, detail="Not found")
     
-    volunteer_folder = get_volunteer_folder(volunteer.id)
-    
     # Generate the PDF first to include it in the download
-    name = volunteer.text3 or f"volunteer_{id}"
-    safe_name = name.replace(" ", "_").replace("/", "_").replace("\\", "_").replace(":", "_")
-    output_filename = f"{safe_name}.pdf"
-    output_path = os.path.join(volunteer_folder, output_filename)
+    inputs = get_pdf_inputs(volunteer)
+    folder_prefix = inputs["volunteer_prefix"]
+    safe_name = inputs["safe_name"]
     
-    # Generate PDF
-    data = {}
-    for i in range(1, 31):
-        val = getattr(volunteer, f"text{i}")
-        data[f"Text{i}"] = val if val else ""
-    
-    attachments = get_attachments_for_pdf(volunteer)
+    render_key = None
     try:
-        photo_path = volunteer.photo_path
-        if photo_path and not os.path.isabs(photo_path):
-            photo_path = os.path.join(UPLOADS_DIR, photo_path)
-        pdf_service.fill_pdf(PDF_TEMPLATE_PATH, output_path, data, photo_path, attachments)
+        render_key = get_pdf_render_key(inputs, ZIP_SAVE_PROFILE)
+        get_or_render_pdf(inputs, render_key, ZIP_SAVE_PROFILE, ensure_folder_copy=True)
     except Exception as e:
         print(f"Error generating PDF for download: {e}")
     
-    # Create ZIP file in memory
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for root, dirs, files in os.walk(volunteer_folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, volunteer_folder)
-                zip_file.write(file_path, arcname)
-    
-    zip_buffer.seek(0)
+    # Files are immutable (UUID names), so the render key plus names and sizes identify the ZIP
+    # Listed from the storage index, so a 304 never reads a file
+    folder_files = [
+        (key, size) for key, size in file_store.list(folder_prefix)
+        if not key.endswith(fragments.STORED_FRAGMENT_SUFFIX)  # render artifacts, not the volunteer's documents
+    ]
+    
+    etag = None
+    if render_key:
+        listing = "\n".join(f"{key[len(folder_prefix) + 1:]}:{size}" for key, size in folder_files)
+        etag = render_cache.etag_for(hashlib.sha256(f"{render_key}\n{listing}".encode("utf-8")).hexdigest())
+        if render_cache.etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    
+    # Stream the ZIP as files are read: media is stored as-is, text is deflated
     zip_filename = f"{safe_name}_files.zip"
     
+    headers = {"Content-Disposition": content_disposition(zip_filename)}
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = "private, no-cache"
     return StreamingResponse(
-        zip_buffer,
+        # Files are fetched into the local cache one at a time, as the ZIP reaches them
+        zip_stream.iter_files((resolve_upload(key), key[len(folder_prefix) + 1:]) for key, _ in folder_files),
         media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
+        headers=headers
     )
 
 @app.post("/delete-folder/{id}")
@@ -579,12 +695,10 @@ def delete_folder(request: Request, id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Not found")
     
     # Delete folder
-    volunteer_folder = get_volunteer_folder(volunteer.id)
-    if os.path.exists(volunteer_folder):
-        try:
-            shutil.rmtree(volunteer_folder)
-        except Exception as e:
-            print(f"Error deleting volunteer folder: {e}")
+    try:
+        file_store.delete_prefix(volunteer_prefix(volunteer.id))
+    except Exception as e:
+        print(f"Error deleting volunteer folder: {e}")
     
     # Clear file references
     volunteer.photo_path = None
@@ -592,47 +706,242 @@ def delete_folder(request: Request, id: int, db: Session = Depends(get_db)):
     for att in volunteer.attachment_list:
         db.delete(att)
     db.commit()
+    pdf_render_queue.schedule(volunteer.id)
     
     return RedirectResponse(url=f"/edit/{id}", status_code=303)
 
+def get_volunteer(db: Session, volunteer_id: int):
+    return db.query(models.Volunteer).filter(models.Volunteer.id == volunteer_id).first()
+
 @app.get("/pdf/{id}")
-def generate_pdf(id: int, request: Request, db: Session = Depends(get_db)):
-    user = get_current_user(request, db)
+async def generate_pdf(id: int, request: Request, profile: Optional[str] = None, db: Session = Depends(get_db)):
+    # Database access stays off the event loop (sqlite on the FUSE mount)
+    user = await run_in_threadpool(get_current_user, request, db)
     if not user:
         return RedirectResponse(url="/login", status_code=303)
     
-    volunteer = db.query(models.Volunteer).filter(models.Volunteer.id == id).first()
+    volunteer = await run_in_threadpool(get_volunteer, db, id)
     if not volunteer:
         raise HTTPException(status_code=404, detail="Not found")
     
-    # Map all 30 text fields to PDF fields (Text1 to Text30)
-    data = {}
-    for i in range(1, 31):
-        val = getattr(volunteer, f"text{i}")
-        data[f"Text{i}"] = val if val else ""
+    save_profile = profile or PDF_SAVE_PROFILE
+    if save_profile not in pdf_service.SAVE_PROFILES:
+        raise HTTPException(status_code=400, detail=f"profile must be one of {', '.join(pdf_service.SAVE_PROFILES)}")
+    
+    # A save usually just queued a background render; let it finish instead of rendering twice
+    await run_in_threadpool(pdf_render_queue.wait, volunteer.id)
     
-    # Generate filename from volunteer name (text3 contains the full name)
-    name = volunteer.text3 or f"volunteer_{id}"
-    # Replace spaces with underscores and remove any problematic characters
-    safe_name = name.replace(" ", "_").replace("/", "_").replace("\\", "_").replace(":", "_")
+    # Stored files may have to be fetched into the local cache first
+    inputs = await run_in_threadpool(get_pdf_inputs, volunteer)
     
-    # Save PDF to volunteer's folder
-    volunteer_folder = get_volunteer_folder(volunteer.id)
-    output_filename = f"{safe_name}.pdf"
-    output_path = os.path.join(volunteer_folder, output_filename)
+    try:
+        # Unchanged forms are served from the render cache; If-None-Match gets a 304
+        render_key = await run_in_threadpool(get_pdf_render_key, inputs, save_profile)
+        headers = {"ETag": render_cache.etag_for(render_key), "Cache-Control": "private, no-cache"}
+        if render_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        
+        pdf_bytes = await get_or_render_pdf_async(inputs, render_key, save_profile)
+        headers["Content-Disposition"] = content_disposition(inputs["output_filename"])
+        return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/preview/{id}")
+async def preview_pdf(id: int, request: Request, dpi: Optional[int] = None, format: Optional[str] = None,
+                      db: Session = Depends(get_db)):
+    """Page one of the volunteer's form as a small PNG/WebP, for a quick visual check."""
+    user = await run_in_threadpool(get_current_user, request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
     
-    # Get attachments
-    attachments = get_attachments_for_pdf(volunteer)
+    volunteer = await run_in_threadpool(get_volunteer, db, id)
+    if not volunteer:
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    image_format = (format or pdf_service.PREVIEW_FORMAT).lower()
+    if image_format not in pdf_service.PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be png or webp")
+    dpi = max(10, min(dpi or pdf_service.PREVIEW_DPI, pdf_service.PREVIEW_MAX_DPI))
+    
+    inputs = await run_in_threadpool(get_pdf_inputs, volunteer)
     
     try:
-        photo_path = volunteer.photo_path
-        if photo_path and not os.path.isabs(photo_path):
-            photo_path = os.path.join(UPLOADS_DIR, photo_path)
-        pdf_service.fill_pdf(PDF_TEMPLATE_PATH, output_path, data, photo_path, attachments)
-        return FileResponse(output_path, filename=output_filename)
+        # Page one is the form page: keyed by its fragment key, so attachments are
+        # neither hashed nor rendered, and any change to the form yields a new preview
+        fragment_key = await run_in_threadpool(render_cache.form_fragment_key, PDF_TEMPLATE_PATH, inputs["data"],
+                                               inputs["photo_path"])
+        key = render_cache.preview_key(fragment_key, dpi, image_format)
+        headers = {"ETag": render_cache.etag_for(key), "Cache-Control": "private, no-cache"}
+        if render_cache.etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        
+        preview_cache = render_cache.get_preview_cache()
+        image = await run_in_threadpool(preview_cache.get, key)
+        if image is None:
+            image = await pdf_render_pool.preview_async(inputs["data"], inputs["photo_path"], dpi, image_format)
+            await run_in_threadpool(preview_cache.put, key, image)
+        return Response(content=image, media_type=pdf_service.PREVIEW_FORMATS[image_format], headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/export/pdf")
+def bulk_export_pdfs(
+    request: Request,
+    ids: Optional[str] = None,
+    q: Optional[str] = None,
+    group: Optional[str] = None,
+    from_id: Optional[int] = None,
+    to_id: Optional[int] = None,
+    format: str = "zip",
+    export_id: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Render many volunteers at once, selected by IDs (e.g. 1,2,10-20), search text,
+    group (text2) or ID range, and stream a ZIP of PDFs or one merged print PDF.
+    Progress is available at /export/progress/{X-Export-Id}; clients can pass
+    their own export_id to poll before the response starts.
+    """
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    if format not in ("zip", "pdf"):
+        raise HTTPException(status_code=400, detail="format must be zip or pdf")
+    try:
+        id_list = bulk_export.parse_ids(ids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid ids: {e}")
+    
+    volunteer_ids = bulk_export.select_volunteer_ids(db, id_list, q, group, from_id, to_id)
+    if not volunteer_ids:
+        raise HTTPException(status_code=404, detail="No volunteers match")
+    if len(volunteer_ids) > bulk_export.BULK_EXPORT_MAX_VOLUNTEERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{len(volunteer_ids)} volunteers match; narrow the selection or use python -m app.bulk_export"
+        )
+    
+    progress = bulk_export.start_progress(len(volunteer_ids), export_id)
+    print(f"[BULK_EXPORT] {progress.export_id}: {len(volunteer_ids)} volunteers as {format}")
+    if format == "zip":
+        content = bulk_export.iter_zip(render_many_volunteers(volunteer_ids, progress))
+        media_type = "application/zip"
+    else:
+        content = render_volunteer_batch(volunteer_ids, progress)
+        media_type = "application/pdf"
+    
+    headers = {
+        "Content-Disposition": content_disposition(f"volunteers_{len(volunteer_ids)}.{format}"),
+        "X-Export-Id": progress.export_id,
+        "Cache-Control": "no-store",
+    }
+    return StreamingResponse(content, media_type=media_type, headers=headers)
+
+@app.get("/export/progress/{export_id}")
+def bulk_export_progress(export_id: str, request: Request, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    progress = bulk_export.get_progress(export_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Not found")
+    return progress.as_dict()
+
+@app.get("/metrics/render")
+def render_metrics(request: Request, db: Session = Depends(get_db)):
+    """Per-stage render timings aggregated since startup (needs RENDER_TIMING=1)."""
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    return render_timing.get_metrics().snapshot()
+
+@app.get("/metrics/storage")
+def storage_metrics(request: Request, db: Session = Depends(get_db)):
+    """Queued background uploads and the last upload error, if any."""
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    return file_store.status()
+
+class PdfJobRequest(BaseModel):
+    """Either volunteer_id (one PDF) or a bulk selection as in /export/pdf."""
+    volunteer_id: Optional[int] = None
+    profile: Optional[str] = None
+    ids: Optional[str] = None
+    q: Optional[str] = None
+    group: Optional[str] = None
+    from_id: Optional[int] = None
+    to_id: Optional[int] = None
+    format: str = "zip"
+
+@app.post("/jobs/pdf", status_code=202)
+def create_pdf_job(payload: PdfJobRequest, request: Request, db: Session = Depends(get_db)):
+    """Queue a render and return at once; poll /jobs/{id} and fetch /jobs/{id}/result."""
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    if payload.volunteer_id is not None:
+        volunteer = db.query(models.Volunteer).filter(models.Volunteer.id == payload.volunteer_id).first()
+        if not volunteer:
+            raise HTTPException(status_code=404, detail="Not found")
+        if payload.profile and payload.profile not in pdf_service.SAVE_PROFILES:
+            raise HTTPException(status_code=400,
+                                detail=f"profile must be one of {', '.join(pdf_service.SAVE_PROFILES)}")
+        job = pdf_jobs.submit(db, "pdf", {"volunteer_id": volunteer.id, "profile": payload.profile}, total=1)
+    else:
+        if payload.format not in ("zip", "pdf"):
+            raise HTTPException(status_code=400, detail="format must be zip or pdf")
+        try:
+            id_list = bulk_export.parse_ids(payload.ids)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid ids: {e}")
+        # Resolved now, so a retry after a restart exports exactly the same volunteers
+        volunteer_ids = bulk_export.select_volunteer_ids(db, id_list, payload.q, payload.group,
+                                                         payload.from_id, payload.to_id)
+        if not volunteer_ids:
+            raise HTTPException(status_code=404, detail="No volunteers match")
+        job = pdf_jobs.submit(db, "bulk", {"volunteer_ids": volunteer_ids, "format": payload.format},
+                              total=len(volunteer_ids))
+    
+    result = jobs.job_to_dict(job)
+    result["status_url"] = f"/jobs/{job.id}"
+    result["result_url"] = f"/jobs/{job.id}/result"
+    return result
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, request: Request, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    job = db.query(models.PdfJob).filter(models.PdfJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Not found")
+    return jobs.job_to_dict(job)
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str, request: Request, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse(url="/login", status_code=303)
+    
+    job = db.query(models.PdfJob).filter(models.PdfJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=410, detail=job.error or "Job failed")
+    if job.status != "done" or not job.result_path or not os.path.exists(job.result_path):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return FileResponse(
+        job.result_path,
+        media_type=job.result_media_type,
+        headers={"Content-Disposition": content_disposition(job.result_name)}
+    )
+
 @app.get("/qr/{id}")
 def get_qr(id: int, request: Request, db: Session = Depends(get_db)):
     user = get_current_user(request, db)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Float, Text
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -61,3 +61,29 @@ class Volunteer(Base):
     
     # Relationship to attachments
     attachment_list = relationship("Attachment", back_populates="volunteer", cascade="all, delete-orphan")
+
+
+class PdfJob(Base):
+    """A queued PDF render or bulk export, persisted so it survives instance restarts."""
+    __tablename__ = "pdf_jobs"
+
+    id = Column(String, primary_key=True, index=True)  # uuid4 hex
+    kind = Column(String, nullable=False)  # "pdf" (one volunteer) or "bulk"
+    params = Column(Text, nullable=False)  # JSON
+    status = Column(String, nullable=False, default="queued", index=True)  # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    error = Column(Text, nullable=True)
+    
+    # Epoch seconds
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    run_after = Column(Float, nullable=False, default=0)  # retry backoff
+    lease_until = Column(Float, nullable=True)  # a running job whose lease expired is picked up again
+    
+    progress_done = Column(Integer, nullable=False, default=0)
+    progress_total = Column(Integer, nullable=False, default=0)
+    
+    result_path = Column(String, nullable=True)
+    result_name = Column(String, nullable=True)
+    result_media_type = Column(String, nullable=True)
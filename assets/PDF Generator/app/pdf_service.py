@@ -1,56 +1,284 @@
 import fitz
+import hashlib
 import os
-import arabic_reshaper
-from bidi.algorithm import get_display
+import threading
+import time
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
 from PIL import Image
-from typing import List, Optional
+
+from . import fonts, images, render_timing, text_layout, text_shaping
+
+
+# Bump whenever a change alters the rendered output, so cached renders are not reused
+RENDERER_VERSION = "5"
+
+# Fixed location of the photo box on the form page
+PHOTO_RECT = fitz.Rect(11.5, 115.0, 103.2, 220.8)
+
+# Named options for Document.tobytes()/save()
+#   fast:    minimal CPU, for interactive /pdf/{id}
+#   compact: garbage collection, deflate and object deduplication, for archives and ZIPs
+#   web:     compact + linearized so viewers can show page one early
+SAVE_PROFILES = {
+    "fast": {"garbage": 0, "deflate": False},
+    "compact": {"garbage": 4, "deflate": True, "use_objstms": 1},
+    "web": {"garbage": 3, "deflate": True, "linear": True},
+}
+
+DEFAULT_SAVE_PROFILE = os.environ.get("PDF_SAVE_PROFILE", "fast")
+
+# Page-one previews for the list and edit pages
+PREVIEW_FORMATS = {"png": "image/png", "webp": "image/webp"}
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "webp")
+PREVIEW_DPI = int(os.environ.get("PREVIEW_DPI", "60"))
+PREVIEW_MAX_DPI = int(os.environ.get("PREVIEW_MAX_DPI", "150"))
+PREVIEW_WEBP_QUALITY = int(os.environ.get("PREVIEW_WEBP_QUALITY", "80"))
+
+# Limits for attachments, so one oversized upload cannot exhaust the instance's
+# memory: pages taken from an attachment PDF, and attachment bytes per render.
+# (The pixel limit for images is images.MAX_IMAGE_PIXELS.) Inputs beyond them
+# are truncated or left out, with a notice page in the PDF.
+MAX_ATTACHMENT_PAGES = int(os.environ.get("MAX_ATTACHMENT_PAGES", "100"))
+RENDER_MEMORY_BUDGET_MB = int(os.environ.get("RENDER_MEMORY_BUDGET_MB", "300"))
+
+NOTICE_COLOR = (0.7, 0.1, 0.1)
+
+# Set to False the first time MuPDF refuses to linearize, so we stop retrying
+_linear_supported = True
+
+
+class CompiledTemplate:
+    """
+    A form template parsed once per process.
+    Holds the widget-free page as PDF bytes plus the field-name -> rect table,
+    so each render only has to open an in-memory document and draw on it.
+    """
+
+    def __init__(self, template_path: str, base_pdf: bytes, field_rects: Dict[str, fitz.Rect], photo_rect: fitz.Rect,
+                 version: str):
+        self.template_path = template_path
+        self.version = version  # SHA256 of the template file
+        self.base_pdf = base_pdf
+        self.field_rects = field_rects
+        self.photo_rect = photo_rect
+
+    def open(self) -> fitz.Document:
+        """Open a fresh, writable copy of the base document."""
+        return fitz.open("pdf", self.base_pdf)
 
 
-def fill_pdf(template_path: str, output_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None):
+_compiled_templates: Dict[str, CompiledTemplate] = {}
+_compiled_templates_lock = threading.Lock()
+
+
+def compile_template(template_path: str) -> CompiledTemplate:
+    """
+    Reads the template, collects the widget rects and deletes all widgets.
+    The result is kept in memory so later renders never touch the template file.
+    """
+    if not os.path.exists(template_path):
+        raise FileNotFoundError(f"Template not found: {template_path}")
+
+    with open(template_path, "rb") as f:
+        template_bytes = f.read()
+    version = hashlib.sha256(template_bytes).hexdigest()
+
+    doc = fitz.open("pdf", template_bytes)
+    try:
+        page = doc[0]
+
+        with render_timing.stage("template_widgets"):
+            # Collect ALL widget info FIRST (before any modifications)
+            field_rects = {}
+            for widget in page.widgets():
+                field_rects[widget.field_name] = fitz.Rect(widget.rect)  # Make a copy of the rect
+
+            # Delete ALL widgets at once
+            # We need to iterate again because deleting while iterating causes issues
+            widgets_to_delete = list(page.widgets())
+            for widget in widgets_to_delete:
+                try:
+                    page.delete_widget(widget)
+                except:
+                    pass  # Some widgets may fail to delete, that's ok
+
+        base_pdf = doc.tobytes(garbage=1)
+    finally:
+        doc.close()
+
+    print(f"Compiled template {template_path}: {len(field_rects)} fields, {len(base_pdf)} bytes")
+    return CompiledTemplate(template_path, base_pdf, field_rects, fitz.Rect(PHOTO_RECT), version)
+
+
+def get_compiled_template(template_path: str) -> CompiledTemplate:
+    """Returns the process-wide compiled template, compiling it on first use."""
+    key = os.path.abspath(template_path)
+    compiled = _compiled_templates.get(key)
+    if compiled is None:
+        with _compiled_templates_lock:
+            compiled = _compiled_templates.get(key)
+            if compiled is None:
+                compiled = compile_template(template_path)
+                _compiled_templates[key] = compiled
+    return compiled
+
+
+def clear_template_cache():
+    """Drops all compiled templates, e.g. after the template file was replaced."""
+    with _compiled_templates_lock:
+        _compiled_templates.clear()
+
+
+def save_document(doc: fitz.Document, profile: str = None) -> bytes:
+    """
+    Serializes the document with a named save profile and reports bytes and save time.
+    Unknown profiles fall back to DEFAULT_SAVE_PROFILE.
+    """
+    profile = profile or DEFAULT_SAVE_PROFILE
+    if profile not in SAVE_PROFILES:
+        print(f"Unknown PDF save profile '{profile}', using '{DEFAULT_SAVE_PROFILE}'")
+        profile = DEFAULT_SAVE_PROFILE if DEFAULT_SAVE_PROFILE in SAVE_PROFILES else "fast"
+    options = dict(SAVE_PROFILES[profile])
+    global _linear_supported
+    if not _linear_supported:
+        options.pop("linear", None)
+
+    start = time.perf_counter()
+    try:
+        pdf_bytes = doc.tobytes(**options)
+    except Exception as e:
+        # Newer MuPDF builds dropped linearization; keep the rest of the profile
+        if not options.pop("linear", False):
+            raise
+        print(f"Linearized save not available ({e}), saving '{profile}' without it")
+        _linear_supported = False
+        pdf_bytes = doc.tobytes(**options)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    render_timing.add("save", elapsed_ms)
+
+    print(f"[PDF_SAVE] profile={profile} bytes={len(pdf_bytes)} time={elapsed_ms:.1f}ms")
+    return pdf_bytes
+
+
+def fill_pdf(template_path: str, output_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None,
+             save_profile: str = None) -> bytes:
     """
     Fills the PDF form fields with data and inserts photo.
     Replaces form fields with flat text to avoid appearance issues.
     Handles Arabic text reshaping and resizing.
     Appends attachments (images/PDFs) as additional pages with titles.
+    The whole document is assembled in memory and written to output_path once.
     
     Args:
         attachments: List of dicts with 'name' and 'file_path' keys
+        save_profile: One of SAVE_PROFILES ("fast", "compact", "web")
+    
+    Returns:
+        The final PDF bytes (same content as written to output_path)
     """
-    if not os.path.exists(template_path):
-        raise FileNotFoundError(f"Template not found: {template_path}")
+    pdf_bytes = render_pdf(template_path, data, photo_path, attachments, save_profile)
+    write_pdf(output_path, pdf_bytes)
+    return pdf_bytes
 
-    doc = fitz.open(template_path)
-    page = doc[0] 
-    
-    # Font Configuration - check multiple possible font paths
-    font_paths = [
-        "C:/Windows/Fonts/arial.ttf",  # Windows
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux (Debian/Ubuntu)
-        "/usr/share/fonts/TTF/DejaVuSans.ttf",  # Linux (Arch)
-        "assets/arial.ttf",  # Bundled font (fallback)
-    ]
-    
-    font_path = None
-    for fp in font_paths:
-        if os.path.exists(fp):
-            font_path = fp
-            break
-    
-    font_name = "Arial"
-    
-    # Register font for the page
-    if font_path and os.path.exists(font_path):
-        page.insert_font(fontname=font_name, fontfile=font_path)
-        calc_font = fitz.Font(fontfile=font_path)
-    else:
-        calc_font = fitz.Font("helv") 
-        font_name = "helv"
-
-    # STEP 1: Collect ALL widget info FIRST (before any modifications)
+
+def render_pdf(template_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None,
+               save_profile: str = None) -> bytes:
+    """
+    Builds the form page and all attachment pages in one in-memory document
+    and returns the final bytes without touching the disk.
+    """
+    pdf_bytes, _ = render_pdf_timed(template_path, data, photo_path, attachments, save_profile)
+    return pdf_bytes
+
+
+def render_pdf_timed(template_path: str, data: dict, photo_path: str = None, attachments: List[dict] = None,
+                     save_profile: str = None) -> Tuple[bytes, Optional[dict]]:
+    """
+    Same as render_pdf, also returning the per-stage timing record
+    (None unless RENDER_TIMING=1). The record is logged here as well.
+    """
+    timer = render_timing.begin(
+        profile=save_profile or DEFAULT_SAVE_PROFILE,
+        fields=sum(1 for value in data.values() if value),
+        photo=bool(photo_path),
+        attachment_count=len(attachments or []),
+    )
+    doc = None
+    try:
+        doc = render_form(template_path, data, photo_path)
+        # Append attachments as additional pages
+        if attachments:
+            add_attachment_pages(doc, attachments)
+        with render_timing.stage("font_subset"):
+            fonts.subset_fonts(doc)
+        pdf_bytes = save_document(doc, save_profile)
+    except Exception as e:
+        render_timing.end(timer, error=str(e))
+        raise
+    finally:
+        if doc is not None:
+            doc.close()
+    return pdf_bytes, render_timing.end(timer, bytes=len(pdf_bytes))
+
+
+def render_preview(pdf_bytes: bytes, dpi: int = None, image_format: str = None) -> bytes:
+    """Rasterizes page one of a rendered PDF to PNG or WebP."""
+    image_format = image_format or PREVIEW_FORMAT
+    with fitz.open("pdf", pdf_bytes) as doc:
+        pix = doc[0].get_pixmap(dpi=dpi or PREVIEW_DPI, alpha=False)
+    if image_format == "png":
+        return pix.tobytes("png")
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buf = BytesIO()
+    img.save(buf, format="WEBP", quality=PREVIEW_WEBP_QUALITY)
+    return buf.getvalue()
+
+
+def write_pdf(output_path: str, pdf_bytes: bytes):
+    """Writes the final bytes in a single sequential write (required for GCS FUSE)."""
+    with open(output_path, "wb") as f:
+        f.write(pdf_bytes)
+
+
+def render_form(template_path: str, data: dict, photo_path: str = None) -> fitz.Document:
+    """
+    Fills the form page from the compiled template and returns the open document.
+    The caller owns the document and must close it.
+    """
+    with render_timing.stage("template_open"):
+        template = get_compiled_template(template_path)
+        doc = template.open()
+    fill_form_page(doc[0], template, data, photo_path)
+    return doc
+
+
+def render_form_overlay(template_path: str, data: dict, photo_path: str = None) -> fitz.Document:
+    """
+    Like render_form, without the template background: only the field values
+    and the photo on a blank page of the template's size (see BatchDocument).
+    The caller owns the document and must close it.
+    """
+    template = get_compiled_template(template_path)
+    with template.open() as background:
+        rect = background[0].rect
+    doc = fitz.open()
+    fill_form_page(doc.new_page(width=rect.width, height=rect.height), template, data, photo_path)
+    return doc
+
+
+def fill_form_page(page: fitz.Page, template: CompiledTemplate, data: dict, photo_path: str = None):
+    """Draws the field values and the photo onto a page laid out like the template."""
+    # Font is resolved and loaded once per process; the page shares its buffer
+    with render_timing.stage("font_register"):
+        font_registry = fonts.get_font_registry()
+        font_name = font_registry.register(page)
+        calc_font = font_registry.measure_font
+
+    # Widgets were already removed when the template was compiled
     widgets_info = []
-    for widget in page.widgets():
-        field_name = widget.field_name
-        rect = fitz.Rect(widget.rect)  # Make a copy of the rect
+    for field_name, rect in template.field_rects.items():
         if field_name in data:
             widgets_info.append({
                 'name': field_name,
@@ -58,16 +286,7 @@ def fill_pdf(template_path: str, output_path: str, data: dict, photo_path: str =
                 'value': data[field_name]
             })
     
-    # STEP 2: Delete ALL widgets at once
-    # We need to iterate again because deleting while iterating causes issues
-    widgets_to_delete = list(page.widgets())
-    for widget in widgets_to_delete:
-        try:
-            page.delete_widget(widget)
-        except:
-            pass  # Some widgets may fail to delete, that's ok
-    
-    # STEP 3: Insert text for each field using saved rect info
+    # Insert text for each field using the compiled rects
     for info in widgets_info:
         rect = info['rect']
         text_value = info['value']
@@ -78,34 +297,31 @@ def fill_pdf(template_path: str, output_path: str, data: dict, photo_path: str =
             
         text = str(text_value)
         
-        # Handle Arabic Text (Reshape & Bidi)
-        try:
-            reshaped_text = arabic_reshaper.reshape(text)
-            bidi_text = get_display(reshaped_text)
-        except Exception:
-            bidi_text = text
+        # Handle Arabic Text (Reshape), bidi is applied per laid-out line
+        with render_timing.stage("text_shaping"):
+            reshaped_text = text_shaping.reshape(text)
         
-        # Calculate Font Size to Fit Width
-        fontsize = 12
-        min_fontsize = 6
-        max_width = rect.width - 2
+        # Font size (and wrapping for long values) computed from one measurement
+        with render_timing.stage("text_layout"):
+            layout = text_layout.layout_text(reshaped_text, rect, calc_font)
         
-        while fontsize > min_fontsize:
-            text_width = calc_font.text_length(bidi_text, fontsize=fontsize)
-            if text_width <= max_width:
-                break
-            fontsize -= 0.5
+        with render_timing.stage("text_shaping"):
+            bidi_text = "\n".join(text_shaping.display(line) for line in layout.lines)
             
         # Insert Text with center alignment
         try:
-            page.insert_textbox(
-                rect, 
-                bidi_text, 
-                fontsize=fontsize, 
-                fontname=font_name,
-                align=1,  # Center
-                color=(0, 0, 0)
-            )
+            with render_timing.stage("text_insert"):
+                rc = page.insert_textbox(
+                    rect, 
+                    bidi_text, 
+                    fontsize=layout.fontsize, 
+                    fontname=font_name,
+                    align=1,  # Center
+                    color=(0, 0, 0),
+                    lineheight=text_layout.LINE_HEIGHT if layout.is_multiline else None
+                )
+            if rc < 0:
+                print(f"Text for {field_name} does not fit its field ({rc:.1f})")
         except Exception as e:
             print(f"Error inserting text for {field_name}: {e}")
     
@@ -116,25 +332,155 @@ def fill_pdf(template_path: str, output_path: str, data: dict, photo_path: str =
         if photo_size == 0:
             print(f"WARNING: Photo file is empty, skipping")
         else:
-            rect = fitz.Rect(11.5, 115.0, 103.2, 220.8)
             try:
-                page.insert_image(rect, filename=photo_path)
+                # Downsampled to the photo box instead of embedding the camera original
+                photo_stream = None
+                too_large = False
+                try:
+                    with render_timing.stage("photo_prepare"):
+                        photo_stream = images.prepare_photo(photo_path, template.photo_rect)
+                except images.ImageTooLarge as e:
+                    # Embedding the original would decode it in full; say so in the box instead
+                    print(f"Photo too large, showing a notice: {e}")
+                    too_large = True
+                except Exception as e:
+                    print(f"Error preparing photo, embedding original: {e}")
+                with render_timing.stage("photo_insert"):
+                    if too_large:
+                        add_photo_notice(page, template.photo_rect, font_name)
+                    elif photo_stream:
+                        page.insert_image(template.photo_rect, stream=photo_stream)
+                    else:
+                        page.insert_image(template.photo_rect, filename=photo_path)
             except Exception as e:
                 print(f"Error inserting photo: {e}")
     elif photo_path:
         print(f"Photo path provided but file not found: {photo_path}")
 
-    doc.save(output_path)
-    doc.close()
-    
-    # Append attachments as additional pages
-    if attachments:
-        append_attachments_to_pdf(output_path, attachments)
+
+class BatchDocument:
+    """
+    Many volunteers' forms in one print document, assembled from fragments
+    rendered elsewhere (see fragments.render_batch_parts). The template
+    background is imported once as a Form XObject and placed under every
+    form overlay with show_pdf_page, so each additional form only adds its
+    own text, photo and attachments instead of another copy of the template.
+    One budget covers everything added to the document.
+    """
+
+    def __init__(self, template_path: str, budget: "RenderBudget" = None):
+        self.template = get_compiled_template(template_path)
+        self.budget = budget or RenderBudget()
+        self.doc = fitz.open()
+        self.forms = 0
+        self._background = self.template.open()
+        self._fonts = fonts.FontMerger(self.doc)
+
+    def add_form(self, overlay: bytes, attachments: List[Tuple[str, Optional[bytes]]] = None) -> bool:
+        """
+        Appends one form (its overlay fragment) followed by its attachment
+        fragments, given as (name, fragment or None if left out of the render).
+        Attachments past the budget get a notice page; returns False, adding
+        nothing, if the form itself no longer fits.
+        """
+        if not self.budget.charge(len(overlay)):
+            return False
+        first_page = self.doc.page_count
+        try:
+            with fitz.open("pdf", overlay) as part:
+                self.doc.insert_pdf(part)
+            page = self.doc[first_page]
+            # Same source page every time, so PyMuPDF reuses the XObject it created first
+            page.show_pdf_page(page.rect, self._background, 0, overlay=False)
+            for name, fragment in attachments or []:
+                if fragment is None or not self.budget.charge(len(fragment)):
+                    add_budget_notice(self.doc, name)
+                    continue
+                with fitz.open("pdf", fragment) as part:
+                    self.doc.insert_pdf(part)
+            # Drops the full font copy each fragment brought along
+            self._fonts.merge(first_page)
+        except Exception:
+            # Leave no half-built form behind
+            if self.doc.page_count > first_page:
+                self.doc.delete_pages(first_page, self.doc.page_count - 1)
+            raise
+        self.forms += 1
+        return True
+
+    def save(self, save_profile: str = None) -> bytes:
+        if self.doc.page_count == 0:
+            self.doc.new_page()
+        fonts.subset_fonts(self.doc)
+        return save_document(self.doc, save_profile)
+
+    def close(self):
+        self._background.close()
+        self.doc.close()
+
+
+class RenderBudget:
+    """
+    Rough memory accounting for the attachments of one render. Each attachment
+    is charged what it adds to the in-memory document (its file size, or its
+    fragment size); once the budget is spent, further attachments are left out.
+    """
+
+    def __init__(self, limit_bytes: int = None):
+        self.limit_bytes = limit_bytes or RENDER_MEMORY_BUDGET_MB * 1024 * 1024
+        self.used_bytes = 0
+
+    def charge(self, size: int) -> bool:
+        if self.used_bytes + size > self.limit_bytes:
+            return False
+        self.used_bytes += size
+        return True
+
+
+def add_notice_page(doc: fitz.Document, title: str, message: str):
+    """A4 page explaining why (part of) an attachment is missing from the PDF."""
+    a4_width, a4_height = 595, 842
+    page = doc.new_page(width=a4_width, height=a4_height)
+    font_name = fonts.get_font_registry().register(page)
+    page.insert_textbox(
+        fitz.Rect(36, 36, a4_width - 36, 80),
+        text_shaping.shape(title),
+        fontsize=24,
+        fontname=font_name,
+        align=1,  # Center
+        color=(0.2, 0.2, 0.6)
+    )
+    page.insert_textbox(
+        fitz.Rect(36, 120, a4_width - 36, 300),
+        text_shaping.shape(message),
+        fontsize=16,
+        fontname=font_name,
+        align=1,
+        color=NOTICE_COLOR
+    )
+
+
+def add_photo_notice(page: fitz.Page, rect: fitz.Rect, font_name: str):
+    """Marks the photo box when the photo could not be included, like the attachment notice pages."""
+    page.draw_rect(rect, color=NOTICE_COLOR, width=0.75)
+    page.insert_textbox(
+        rect + (4, 4, -4, -4),
+        # Shaped line by line; wrapping shaped text would put the lines in reverse order
+        "\n".join(text_shaping.shape(line) for line in ("الصورة كبيرة جداً", "ولم يتم تضمينها")),
+        fontsize=9,
+        fontname=font_name,
+        align=1,  # Center
+        color=NOTICE_COLOR
+    )
+
+
+def add_budget_notice(doc: fitz.Document, attachment_name: str):
+    add_notice_page(doc, attachment_name, "لم يتم تضمين هذا المرفق لأن حجم المرفقات تجاوز الحد المسموح به للطباعة")
 
 
 def append_attachments_to_pdf(pdf_path: str, attachments: List[dict]):
     """
-    Appends attachment files (images or PDFs) as additional pages to the PDF.
+    Appends attachment files (images or PDFs) as additional pages to an existing PDF file.
     Each attachment gets a title header with its name.
     
     Args:
@@ -144,25 +490,33 @@ def append_attachments_to_pdf(pdf_path: str, attachments: List[dict]):
         print("No attachments to append")
         return
     
-    print(f"Appending {len(attachments)} attachments to PDF")
-    
     doc = fitz.open(pdf_path)
+    try:
+        add_attachment_pages(doc, attachments)
+        fonts.subset_fonts(doc)
+        pdf_bytes = save_document(doc)
+    finally:
+        doc.close()
     
-    # Font Configuration for title
-    font_paths = [
-        "C:/Windows/Fonts/arial.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        "/usr/share/fonts/TTF/DejaVuSans.ttf",
-        "assets/arial.ttf",
-    ]
+    # Written back in one pass instead of save-to-temp/remove/rename
+    write_pdf(pdf_path, pdf_bytes)
+
+
+def add_attachment_pages(doc: fitz.Document, attachments: List[dict], budget: RenderBudget = None):
+    """
+    Appends attachment files (images or PDFs) as additional pages to an open document.
+    Each attachment gets a title header with its name.
+    Oversized images, PDFs beyond MAX_ATTACHMENT_PAGES and attachments past the
+    memory budget get a notice page instead of (or after) their content.
     
-    font_path = None
-    for fp in font_paths:
-        if os.path.exists(fp):
-            font_path = fp
-            break
+    Args:
+        attachments: List of dicts with 'name' and 'file_path' keys
+        budget: Shared across calls that build one render; a fresh one by default
+    """
+    budget = budget or RenderBudget()
+    print(f"Appending {len(attachments)} attachments to PDF")
     
-    font_name = "Arial" if font_path else "helv"
+    font_registry = fonts.get_font_registry()
     
     for attachment in attachments:
         attachment_name = attachment.get('name', 'مرفق')
@@ -182,6 +536,13 @@ def append_attachments_to_pdf(pdf_path: str, attachments: List[dict]):
             continue
         
         ext = os.path.splitext(attachment_path)[1].lower()
+        start = time.perf_counter()
+        pages_before = doc.page_count
+        
+        if not budget.charge(file_size):
+            print(f"Render memory budget spent, leaving out {attachment_path}")
+            add_budget_notice(doc, attachment_name)
+            continue
         
         try:
             if ext == '.pdf':
@@ -190,15 +551,9 @@ def append_attachments_to_pdf(pdf_path: str, attachments: List[dict]):
                 title_page = doc.new_page(width=a4_width, height=a4_height)
                 
                 # Add title
-                title_text = attachment_name
-                try:
-                    reshaped = arabic_reshaper.reshape(title_text)
-                    title_text = get_display(reshaped)
-                except:
-                    pass
+                title_text = text_shaping.shape(attachment_name)
                 
-                if font_path:
-                    title_page.insert_font(fontname=font_name, fontfile=font_path)
+                font_name = font_registry.register(title_page)
                 
                 title_page.insert_textbox(
                     fitz.Rect(36, 36, a4_width - 36, 80),
@@ -209,72 +564,73 @@ def append_attachments_to_pdf(pdf_path: str, attachments: List[dict]):
                     color=(0.2, 0.2, 0.6)
                 )
                 
-                # Merge PDF pages after title
+                # Merge PDF pages after title, up to MAX_ATTACHMENT_PAGES
                 attachment_doc = fitz.open(attachment_path)
-                doc.insert_pdf(attachment_doc)
-                attachment_doc.close()
+                try:
+                    total_pages = attachment_doc.page_count
+                    doc.insert_pdf(attachment_doc, to_page=min(total_pages, MAX_ATTACHMENT_PAGES) - 1)
+                finally:
+                    attachment_doc.close()
+                if total_pages > MAX_ATTACHMENT_PAGES:
+                    print(f"Attachment {attachment_path} truncated to {MAX_ATTACHMENT_PAGES} of {total_pages} pages")
+                    add_notice_page(doc, attachment_name,
+                                    f"تم تضمين أول {MAX_ATTACHMENT_PAGES} صفحة فقط من أصل {total_pages} صفحة")
                 
             elif ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
                 # Convert image to PDF page with title
-                img = Image.open(attachment_path)
-                img_width, img_height = img.size
-                
                 # A4 size: 595 x 842 points
                 a4_width, a4_height = 595, 842
                 
-                # Create new page
-                new_page = doc.new_page(width=a4_width, height=a4_height)
+                # Calculate the box that fits the image on page with margins and title space
+                margin = 36
+                title_space = 70  # Space for title
+                max_width = a4_width - 2 * margin
+                max_height = a4_height - title_space - 2 * margin
                 
-                # Add title at top
-                title_text = attachment_name
+                # Decoded once, EXIF-oriented and downscaled to the box at ATTACHMENT_DPI
                 try:
-                    reshaped = arabic_reshaper.reshape(title_text)
-                    title_text = get_display(reshaped)
-                except:
-                    pass
+                    image_stream, (img_width, img_height) = images.prepare_attachment_image(
+                        attachment_path, max_width, max_height
+                    )
+                except images.ImageTooLarge as e:
+                    print(f"Attachment image too large: {e}")
+                    megapixels = f" ({e.pixels / 1e6:.0f} ميغابكسل)" if e.pixels else ""
+                    add_notice_page(doc, attachment_name,
+                                    f"لم يتم تضمين هذه الصورة لأن أبعادها كبيرة جداً{megapixels}")
+                    image_stream = None
                 
-                if font_path:
-                    new_page.insert_font(fontname=font_name, fontfile=font_path)
+                if image_stream is not None:
+                    # Create new page
+                    new_page = doc.new_page(width=a4_width, height=a4_height)
                 
-                new_page.insert_textbox(
-                    fitz.Rect(36, 20, a4_width - 36, 60),
-                    title_text,
-                    fontsize=20,
-                    fontname=font_name,
-                    align=1,  # Center
-                    color=(0.2, 0.2, 0.6)
-                )
+                    # Add title at top
+                    title_text = text_shaping.shape(attachment_name)
                 
-                # Calculate scaling to fit image on page with margins and title space
-                margin = 36
-                title_space = 70  # Space for title
-                max_width = a4_width - 2 * margin
-                max_height = a4_height - title_space - 2 * margin
+                    font_name = font_registry.register(new_page)
                 
-                scale = min(max_width / img_width, max_height / img_height)
-                new_width = img_width * scale
-                new_height = img_height * scale
+                    new_page.insert_textbox(
+                        fitz.Rect(36, 20, a4_width - 36, 60),
+                        title_text,
+                        fontsize=20,
+                        fontname=font_name,
+                        align=1,  # Center
+                        color=(0.2, 0.2, 0.6)
+                    )
                 
-                # Center the image horizontally, place below title
-                x_offset = (a4_width - new_width) / 2
-                y_offset = title_space + margin
+                    scale = min(max_width / img_width, max_height / img_height)
+                    new_width = img_width * scale
+                    new_height = img_height * scale
                 
-                rect = fitz.Rect(x_offset, y_offset, x_offset + new_width, y_offset + new_height)
-                new_page.insert_image(rect, filename=attachment_path)
+                    # Center the image horizontally, place below title
+                    x_offset = (a4_width - new_width) / 2
+                    y_offset = title_space + margin
                 
-                img.close()
+                    rect = fitz.Rect(x_offset, y_offset, x_offset + new_width, y_offset + new_height)
+                    new_page.insert_image(rect, stream=image_stream)
             else:
                 print(f"Unsupported attachment format: {ext}")
         except Exception as e:
             print(f"Error processing attachment {attachment_path}: {e}")
-    
-    # Save to a temporary file first to avoid "save to original must be incremental" error
-    temp_output = pdf_path + ".tmp"
-    doc.save(temp_output)
-    doc.close()
-    
-    # Replace original file
-    if os.path.exists(pdf_path):
-        os.remove(pdf_path)
-    os.rename(temp_output, pdf_path)
+        render_timing.attachment(ext, file_size, (time.perf_counter() - start) * 1000,
+                                 doc.page_count - pages_before)
 
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from . import images, pdf_service
+
+
+# Rendered PDFs are cached on local disk (not the FUSE mount), bounded in size
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vms_render_cache"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Page-one preview images, in a subfolder of the render cache
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Thumbnails of uploaded images (see main.thumbnail), in a subfolder too
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Separately rendered form pages and attachments (see fragments.py), in a subfolder too
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get("FRAGMENT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Downsampled photos and image attachments (see images.py), in a subfolder too
+DERIVED_CACHE_MAX_BYTES = int(os.environ.get("DERIVED_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class RenderCache:
+    """
+    Content-addressed store for rendered PDFs with size-bounded LRU eviction.
+    Keys are hex digests from render_key(); each entry is one file on disk.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, extension: str = ".pdf", shared: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        # Shared caches are written by several processes (render workers), so a
+        # miss in this process's index still checks the disk
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, oldest first
+        self._total_bytes = 0
+        self._loaded = False
+
+    def _load(self):
+        # Rebuild the LRU order from access times of what is already on disk
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.extension):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            found.append((st.st_atime, name[:-len(self.extension)], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{self.extension}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        self._ensure_loaded()
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+            elif not self.shared:
+                return None
+        try:
+            path = self.path_for(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            # Keeps the LRU order meaningful across restarts (see _load)
+            os.utime(path)
+            if not known:
+                # Written by another process since this one loaded the folder
+                with self._lock:
+                    if key not in self._entries:
+                        self._entries[key] = len(data)
+                        self._total_bytes += len(data)
+            return data
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+    def put(self, key: str, data: bytes):
+        self._ensure_loaded()
+        if len(data) > self.max_bytes:
+            return
+        path = self.path_for(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            old_size = self._entries.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            evicted = self._evict_locked()
+
+        for old_key in evicted:
+            try:
+                os.remove(self.path_for(old_key))
+            except FileNotFoundError:
+                pass
+
+    def _evict_locked(self) -> List[str]:
+        evicted = []
+        while self._total_bytes > self.max_bytes and self._entries:
+            old_key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(old_key)
+        return evicted
+
+    def clear(self):
+        self._ensure_loaded()
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self._total_bytes = 0
+        for key in keys:
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+
+
+_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES)
+_preview_cache = RenderCache(os.path.join(RENDER_CACHE_DIR, "previews"), PREVIEW_CACHE_MAX_BYTES, ".img")
+_fragment_cache = RenderCache(os.path.join(RENDER_CACHE_DIR, "fragments"), FRAGMENT_CACHE_MAX_BYTES, shared=True)
+_thumbnail_cache = RenderCache(os.path.join(RENDER_CACHE_DIR, "thumbnails"), THUMBNAIL_CACHE_MAX_BYTES, ".img")
+_derived_cache = RenderCache(os.path.join(RENDER_CACHE_DIR, "derived"), DERIVED_CACHE_MAX_BYTES, ".jpg",
+                             shared=True)
+
+
+def get_render_cache() -> RenderCache:
+    return _cache
+
+
+def get_preview_cache() -> RenderCache:
+    return _preview_cache
+
+
+def get_fragment_cache() -> RenderCache:
+    return _fragment_cache
+
+
+def get_thumbnail_cache() -> RenderCache:
+    return _thumbnail_cache
+
+
+def get_derived_cache() -> RenderCache:
+    return _derived_cache
+
+
+def file_identity(path: Optional[str]) -> Optional[str]:
+    """Content hash of an input file, or None if there is no usable file."""
+    if not path:
+        return None
+    try:
+        if os.path.getsize(path) == 0:
+            return None
+        return images.content_hash(path)
+    except OSError:
+        return None
+
+
+def _digest(identity: dict) -> str:
+    encoded = json.dumps(identity, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def render_key(template_path: str, data: dict, photo_path: Optional[str], attachments: Optional[List[dict]],
+               save_profile: Optional[str] = None) -> str:
+    """
+    Hash of everything that determines the rendered bytes: the text fields,
+    photo and attachment content, template version, renderer version and save profile.
+    """
+    template = pdf_service.get_compiled_template(template_path)
+    identity = {
+        "fields": {k: str(v) if v else "" for k, v in data.items()},
+        "photo": file_identity(photo_path),
+        "attachments": [
+            {
+                "name": att.get("name", ""),
+                "ext": os.path.splitext(att.get("file_path", ""))[1].lower(),
+                "content": file_identity(att.get("file_path")),
+            }
+            for att in (attachments or [])
+        ],
+        "template": template.version,
+        "renderer": pdf_service.RENDERER_VERSION,
+        "limits": [images.MAX_IMAGE_PIXELS, pdf_service.MAX_ATTACHMENT_PAGES, pdf_service.RENDER_MEMORY_BUDGET_MB],
+        "profile": save_profile or pdf_service.DEFAULT_SAVE_PROFILE,
+    }
+    return _digest(identity)
+
+
+def form_fragment_key(template_path: str, data: dict, photo_path: Optional[str], overlay: bool = False) -> str:
+    """
+    Key of the filled form page alone: text fields, photo, template and photo settings.
+    `overlay` keys the same page without its background (pdf_service.render_form_overlay).
+    """
+    template = pdf_service.get_compiled_template(template_path)
+    return _digest({
+        "fragment": "overlay" if overlay else "form",
+        "fields": {k: str(v) if v else "" for k, v in data.items()},
+        "photo": file_identity(photo_path),
+        "photo_settings": [images.PHOTO_DPI, images.PHOTO_JPEG_QUALITY, images.MAX_IMAGE_PIXELS],
+        "template": template.version,
+        "renderer": pdf_service.RENDERER_VERSION,
+    })
+
+
+def attachment_fragment_key(attachment: dict) -> Optional[str]:
+    """
+    Key of one attachment's pages: its title and file content, so the same
+    document under the same title is reused across edits. None if the file
+    is missing or empty (it adds no pages).
+    """
+    file_path = attachment.get("file_path", "")
+    content = file_identity(file_path)
+    if content is None:
+        return None
+    return _digest({
+        "fragment": "attachment",
+        "name": attachment.get("name", "مرفق"),
+        "ext": os.path.splitext(file_path)[1].lower(),
+        "content": content,
+        "image_settings": [images.ATTACHMENT_DPI, images.ATTACHMENT_JPEG_QUALITY],
+        "limits": [images.MAX_IMAGE_PIXELS, pdf_service.MAX_ATTACHMENT_PAGES],
+        "renderer": pdf_service.RENDERER_VERSION,
+    })
+
+
+def preview_key(fragment_key: str, dpi: int, image_format: str) -> str:
+    """Key of a page-one preview; changes whenever the form fragment key does."""
+    return hashlib.sha256(f"{fragment_key}:preview:{dpi}:{image_format}".encode("utf-8")).hexdigest()
+
+
+def thumbnail_key(version: str, width: int, image_format: str) -> str:
+    """Key of an image thumbnail; `version` identifies the source file (see main.upload_version)."""
+    identity = f"{version}:thumbnail:{width}:{image_format}:{images.THUMBNAIL_QUALITY}:{images.MAX_IMAGE_PIXELS}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def etag_for(key: str) -> str:
+    """Strong ETag for a render key."""
+    return f'"{key}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True if an If-None-Match header matches the given strong ETag."""
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
@@ -0,0 +1,165 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+from . import fragments, images, pdf_service, render_timing
+
+
+# Number of render processes; 0 renders in the calling thread (no pool)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+
+def _init_worker(template_path: str):
+    """Runs once in each worker: compile the template and load the font up front."""
+    from . import fonts
+    try:
+        pdf_service.get_compiled_template(template_path)
+        fonts.get_font_registry()
+    except Exception as e:
+        print(f"[RENDER_POOL] Worker {os.getpid()} warm-up failed: {e}")
+
+
+def _warm():
+    return os.getpid()
+
+
+def _render(template_path: str, data: dict, photo_path: Optional[str], attachments: Optional[List[dict]],
+            save_profile: Optional[str]) -> Tuple[bytes, Optional[dict]]:
+    # Only changed fragments are rendered; the timing record travels back so the
+    # parent process can aggregate metrics
+    return fragments.render_pdf_timed(template_path, data, photo_path, attachments, save_profile)
+
+
+def _finish(result: Tuple[bytes, Optional[dict]]) -> bytes:
+    pdf_bytes, timing = result
+    render_timing.get_metrics().observe(timing)
+    return pdf_bytes
+
+
+class RenderPool:
+    """
+    Renders PDFs in worker processes so PyMuPDF, image decoding and shaping
+    do not compete with request handling for the GIL.
+    Workers are started ahead of time and keep the compiled template and fonts warm.
+    """
+
+    def __init__(self, template_path: str, workers: int = RENDER_WORKERS):
+        self.template_path = template_path
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def start(self):
+        """Start all worker processes now instead of on the first render."""
+        if not self.enabled:
+            return
+        executor = self._get_executor()
+        pids = {f.result() for f in [executor.submit(_warm) for _ in range(self.workers)]}
+        print(f"[RENDER_POOL] {len(pids)} render worker(s) ready")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: the parent runs threads (server, pre-render queue)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.template_path,),
+                )
+            return self._executor
+
+    def _reset_executor(self, broken: Optional[ProcessPoolExecutor]):
+        with self._lock:
+            if broken is None or self._executor is not broken:
+                return
+            self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args) -> Future:
+        if not self.enabled:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        executor = self._get_executor()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool once
+            print("[RENDER_POOL] Pool broken, restarting workers")
+            self._reset_executor(executor)
+            return self._get_executor().submit(fn, *args)
+
+    async def _call_async(self, fn, *args):
+        if not self.enabled:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, fn, *args)
+        try:
+            return await asyncio.wrap_future(self._submit(fn, *args))
+        except BrokenProcessPool:
+            print("[RENDER_POOL] Worker died during render, retrying once")
+            self._reset_executor(self._executor)
+            return await asyncio.wrap_future(self._submit(fn, *args))
+
+    def submit(self, data: dict, photo_path: Optional[str] = None, attachments: Optional[List[dict]] = None,
+               save_profile: Optional[str] = None) -> Future:
+        """Queue a render; the future resolves to (PDF bytes, timing record or None)."""
+        return self._submit(_render, self.template_path, data, photo_path, attachments, save_profile)
+
+    def render(self, data: dict, photo_path: Optional[str] = None, attachments: Optional[List[dict]] = None,
+               save_profile: Optional[str] = None) -> bytes:
+        """Blocking render, for background threads and scripts."""
+        try:
+            return _finish(self.submit(data, photo_path, attachments, save_profile).result())
+        except BrokenProcessPool:
+            print("[RENDER_POOL] Worker died during render, retrying once")
+            self._reset_executor(self._executor)
+            return _finish(self.submit(data, photo_path, attachments, save_profile).result())
+
+    async def render_async(self, data: dict, photo_path: Optional[str] = None,
+                           attachments: Optional[List[dict]] = None, save_profile: Optional[str] = None) -> bytes:
+        """Render from an async route handler without blocking the event loop."""
+        return _finish(await self._call_async(_render, self.template_path, data, photo_path, attachments,
+                                              save_profile))
+
+    def batch_parts(self, data: dict, photo_path: Optional[str] = None,
+                    attachments: Optional[List[dict]] = None) -> tuple:
+        """Blocking; one volunteer's fragments for a bulk print document (see fragments.render_batch_parts)."""
+        args = (fragments.render_batch_parts, self.template_path, data, photo_path, attachments)
+        try:
+            return self._submit(*args).result()
+        except BrokenProcessPool:
+            print("[RENDER_POOL] Worker died during render, retrying once")
+            self._reset_executor(self._executor)
+            return self._submit(*args).result()
+
+    async def preview_async(self, data: dict, photo_path: Optional[str], dpi: int, image_format: str) -> bytes:
+        """Page one (the form page) as an image, in a worker (see fragments.render_form_preview)."""
+        return await self._call_async(fragments.render_form_preview, self.template_path, data, photo_path, dpi,
+                                      image_format)
+
+    async def thumbnail_async(self, image_path: str, width: int, image_format: str) -> bytes:
+        """Thumbnail of an uploaded image in a worker (see images.render_thumbnail)."""
+        return await self._call_async(images.render_thumbnail, image_path, width, image_format)
+
+    async def prepare_attachment_async(self, file_path: str, name: str, fragment_path: str = None) -> int:
+        """Upload-time validation and fragment build in a worker (see fragments.prepare_attachment)."""
+        return await self._call_async(fragments.prepare_attachment, file_path, name, fragment_path)
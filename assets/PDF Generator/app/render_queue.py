@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Set
+
+
+# Background pre-rendering after edits and uploads
+PRERENDER_ENABLED = os.environ.get("PRERENDER_ENABLED", "1") == "1"
+# Several saves in a row (form, then photo, then attachments) collapse into one render
+PRERENDER_DEBOUNCE_SECONDS = float(os.environ.get("PRERENDER_DEBOUNCE_SECONDS", "2"))
+PRERENDER_WORKERS = int(os.environ.get("PRERENDER_WORKERS", "1"))
+# How long /pdf/{id} waits on a queued or in-flight render before rendering itself
+PRERENDER_WAIT_SECONDS = float(os.environ.get("PRERENDER_WAIT_SECONDS", "60"))
+
+
+class RenderQueue:
+    """
+    Debounced per-volunteer render jobs run on background threads.
+    schedule() (re)arms a job; wait() promotes a pending job to run now and
+    blocks until the latest render for that volunteer has finished.
+    """
+
+    def __init__(self, render_fn: Callable[[int], None], debounce_seconds: float = PRERENDER_DEBOUNCE_SECONDS,
+                 workers: int = PRERENDER_WORKERS, enabled: bool = PRERENDER_ENABLED):
+        self.render_fn = render_fn
+        self.debounce_seconds = debounce_seconds
+        self.workers = max(1, workers)
+        self.enabled = enabled
+        self._cond = threading.Condition()
+        self._pending: Dict[int, float] = {}  # volunteer_id -> due time (monotonic)
+        self._in_flight: Set[int] = set()
+        self._done: Dict[int, threading.Event] = {}  # set when no newer job is queued
+        self._threads = []
+
+    def _start_workers(self):
+        # Called with the condition held
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"pdf-prerender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def schedule(self, volunteer_id: int):
+        """Queue a render for the volunteer, pushing back any pending one."""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._pending[volunteer_id] = time.monotonic() + self.debounce_seconds
+            if volunteer_id not in self._done:
+                self._done[volunteer_id] = threading.Event()
+            self._start_workers()
+            self._cond.notify_all()
+
+    def cancel(self, volunteer_id: int):
+        """Drop a pending job, e.g. when the volunteer was deleted."""
+        with self._cond:
+            self._pending.pop(volunteer_id, None)
+            if volunteer_id not in self._in_flight:
+                event = self._done.pop(volunteer_id, None)
+                if event:
+                    event.set()
+
+    def wait(self, volunteer_id: int, timeout: float = PRERENDER_WAIT_SECONDS) -> bool:
+        """
+        Wait for the queued or in-flight render of a volunteer.
+        Returns False if there was nothing to wait for or the timeout expired.
+        """
+        with self._cond:
+            event = self._done.get(volunteer_id)
+            if event is None:
+                return False
+            if volunteer_id in self._pending:
+                # Someone is asking for it now, skip the rest of the debounce
+                self._pending[volunteer_id] = 0
+                self._cond.notify_all()
+        return event.wait(timeout)
+
+    def _next_job(self):
+        # Called with the condition held; returns (volunteer_id, seconds until due)
+        candidates = [(due, vid) for vid, due in self._pending.items() if vid not in self._in_flight]
+        if not candidates:
+            return None, None
+        due, volunteer_id = min(candidates)
+        return volunteer_id, due - time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                volunteer_id, delay = self._next_job()
+                if volunteer_id is None:
+                    self._cond.wait()
+                    continue
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                del self._pending[volunteer_id]
+                self._in_flight.add(volunteer_id)
+
+            start = time.perf_counter()
+            try:
+                self.render_fn(volunteer_id)
+                print(f"[PRERENDER] volunteer {volunteer_id} rendered in {(time.perf_counter() - start) * 1000:.0f}ms")
+            except Exception as e:
+                print(f"[PRERENDER] Error rendering volunteer {volunteer_id}: {e}")
+            finally:
+                with self._cond:
+                    self._in_flight.discard(volunteer_id)
+                    # If it was rescheduled meanwhile, waiters keep waiting for the newer render
+                    if volunteer_id not in self._pending:
+                        event = self._done.pop(volunteer_id, None)
+                        if event:
+                            event.set()
+                    self._cond.notify_all()
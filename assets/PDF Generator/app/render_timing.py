@@ -0,0 +1,142 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+
+# Per-stage render timings; off by default so renders pay nothing for them
+RENDER_TIMING = os.environ.get("RENDER_TIMING", "0") == "1"
+
+# Shared no-op returned by stage() when timing is off or no render is being timed
+_NOOP = contextlib.nullcontext()
+
+_current: "contextvars.ContextVar[Optional[RenderTimer]]" = contextvars.ContextVar("render_timer", default=None)
+
+
+class RenderTimer:
+    """Collects stage durations (ms) for one render; repeated stages are summed."""
+
+    def __init__(self, **context):
+        self.context = context
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.attachments = []
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def add(self, name: str, ms: float):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def as_dict(self) -> dict:
+        record = dict(self.context)
+        record["total_ms"] = round((time.perf_counter() - self._start) * 1000, 1)
+        record["stages_ms"] = {name: round(ms, 1) for name, ms in self.stages.items()}
+        record["stage_counts"] = {name: n for name, n in self.counts.items() if n > 1}
+        record["attachments"] = self.attachments
+        record["pid"] = os.getpid()
+        return record
+
+
+def begin(**context) -> Optional[RenderTimer]:
+    """Starts timing a render in the current context; returns None when timing is off."""
+    if not RENDER_TIMING:
+        return None
+    timer = RenderTimer(**context)
+    _current.set(timer)
+    return timer
+
+
+def end(timer: Optional[RenderTimer], **context) -> Optional[dict]:
+    """Finishes a render: logs one structured record and returns it (None when off)."""
+    if timer is None:
+        return None
+    _current.set(None)
+    timer.context.update(context)
+    record = timer.as_dict()
+    # One JSON line per render; Cloud Logging turns it into a structured entry
+    print(json.dumps({
+        "severity": "INFO",
+        "message": f"[RENDER_TIMING] {record['total_ms']:.0f}ms",
+        "render_timing": record,
+    }, ensure_ascii=False))
+    return record
+
+
+def stage(name: str):
+    """Context manager timing one stage of the current render (no-op when off)."""
+    timer = _current.get()
+    if timer is None:
+        return _NOOP
+    return timer.stage(name)
+
+
+def add(name: str, ms: float):
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, ms)
+
+
+def attachment(kind: str, size: int, ms: float, pages: int = 0):
+    """Records one attachment of the current render with its type and file size."""
+    timer = _current.get()
+    if timer is not None:
+        timer.attachments.append({"type": kind, "bytes": size, "pages": pages, "ms": round(ms, 1)})
+
+
+class RenderMetrics:
+    """Process-wide aggregates of render records, per stage: count, total, max."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.renders = 0
+        self._stages: Dict[str, Dict[str, float]] = {}
+
+    def observe(self, record: Optional[dict]):
+        if not record:
+            return
+        with self._lock:
+            self.renders += 1
+            stages = dict(record.get("stages_ms", {}))
+            stages["total"] = record.get("total_ms", 0.0)
+            for att in record.get("attachments", []):
+                key = f"attachment_{att['type'].lstrip('.')}"
+                stages[key] = stages.get(key, 0.0) + att["ms"]
+            for name, ms in stages.items():
+                agg = self._stages.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                agg["count"] += 1
+                agg["total_ms"] += ms
+                agg["max_ms"] = max(agg["max_ms"], ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": RENDER_TIMING,
+                "renders": self.renders,
+                "stages": {
+                    name: {
+                        "count": agg["count"],
+                        "avg_ms": round(agg["total_ms"] / agg["count"], 1),
+                        "max_ms": round(agg["max_ms"], 1),
+                        "total_ms": round(agg["total_ms"], 1),
+                    }
+                    for name, agg in sorted(self._stages.items())
+                },
+            }
+
+
+_metrics = RenderMetrics()
+
+
+def get_metrics() -> RenderMetrics:
+    return _metrics
@@ -0,0 +1,514 @@
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+# Uploaded photos and attachments, keyed by their path relative to this folder
+# (the same relative paths that are stored in the database)
+DATA_DIR = os.environ.get("DATA_DIR", ".")
+UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+# local: plain disk; fuse: the GCS bucket mounted at DATA_DIR; memory: in-process, for tests
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "fuse" if "DATA_DIR" in os.environ else "local")
+# Local copies of stored files, so renders and downloads do not read through FUSE
+STORAGE_CACHE_DIR = os.environ.get("STORAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vms_storage_cache"))
+STORAGE_CACHE_MAX_BYTES = int(os.environ.get("STORAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Upload regenerable files (the folder's PDF copy) on a background thread instead of
+# inside the request. Originals are always written through. Off by default: Cloud Run
+# throttles CPU between requests, which can hold queued uploads back.
+STORAGE_WRITE_BACK = os.environ.get("STORAGE_WRITE_BACK", "0") == "1"
+# How long sizes and folder listings from the backend are trusted. Other instances
+# write to the same bucket, so keep this short.
+STORAGE_INDEX_TTL_SECONDS = float(os.environ.get("STORAGE_INDEX_TTL_SECONDS", "30"))
+# Longest wait between retries of a failing background upload
+STORAGE_RETRY_MAX_SECONDS = float(os.environ.get("STORAGE_RETRY_MAX_SECONDS", "60"))
+# Longest wait for queued uploads on shutdown or before a folder is deleted
+STORAGE_FLUSH_TIMEOUT_SECONDS = float(os.environ.get("STORAGE_FLUSH_TIMEOUT_SECONDS", "8"))
+
+# Journal of queued uploads, inside the cache directory
+PENDING_JOURNAL_DIR = "pending"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def normalize_key(key: str) -> str:
+    """Canonical form of a relative key; rejects absolute paths and "..", which could leave the root."""
+    parts = [part for part in key.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(key) or ":" in parts[0]:
+        raise ValueError(f"Invalid storage key: {key!r}")
+    return "/".join(parts)
+
+
+def copy_file(src_path: str, dest_path: str):
+    """Copies in one sequential pass: one open, in-order writes (what GCS FUSE needs)."""
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+class FilesystemBackend:
+    """Files under a root directory: local disk, or a bucket mounted with GCS FUSE."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def size(self, key: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def read_to(self, key: str, dest_path: str):
+        copy_file(self.path(key), dest_path)
+
+    def write_from(self, key: str, src_path: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        copy_file(src_path, path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix: str):
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+    def list(self, prefix: str) -> List[Tuple[str, int]]:
+        folder = self.path(prefix)
+        found = []
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                file_path = os.path.join(root, name)
+                key = os.path.relpath(file_path, self.root).replace("\\", "/")
+                try:
+                    found.append((key, os.path.getsize(file_path)))
+                except OSError:
+                    pass
+        return found
+
+
+class MemoryBackend:
+    """Keeps files in a dict; for tests and local experiments."""
+
+    def __init__(self):
+        self._files: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Optional[str]:
+        return None
+
+    def size(self, key: str) -> Optional[int]:
+        data = self._files.get(key)
+        return None if data is None else len(data)
+
+    def read_to(self, key: str, dest_path: str):
+        with open(dest_path, "wb") as f:
+            f.write(self._files[key])
+
+    def write_from(self, key: str, src_path: str):
+        with open(src_path, "rb") as f:
+            data = f.read()
+        with self._lock:
+            self._files[key] = data
+
+    def delete(self, key: str):
+        with self._lock:
+            self._files.pop(key, None)
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._files if k.startswith(prefix + "/")]:
+                del self._files[key]
+
+    def list(self, prefix: str) -> List[Tuple[str, int]]:
+        with self._lock:
+            return [(k, len(v)) for k, v in self._files.items() if k.startswith(prefix + "/")]
+
+
+class Storage:
+    """
+    Front for a storage backend that keeps request handlers off the object store:
+    - a metadata index of file sizes and folder listings, so existence and size
+      checks are answered from memory;
+    - a size-bounded local read cache, so files are read through FUSE once and
+      renders get a local path;
+    - optional write-back for files that can be regenerated (the folder's PDF
+      copy): they are uploaded by one background thread, in order, so a later
+      delete cannot overtake a write. Until uploaded they stay in the cache with
+      a journal entry, so a restart uploads them instead of wiping them, and a
+      failing upload is retried rather than dropped.
+    Originals (photos, attachments) are always written through before the
+    request returns, so other instances see them at once.
+    Without a cache directory, files are used in place on the backend (local disk).
+    """
+
+    def __init__(self, backend, cache_dir: Optional[str] = None, cache_max_bytes: int = STORAGE_CACHE_MAX_BYTES,
+                 write_back: bool = False):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.write_back = write_back and cache_dir is not None
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, Tuple[int, float]] = {}  # key -> (size, when learned)
+        self._listed: Dict[str, float] = {}  # prefix -> when listed
+        self._deleted = set()  # deleted here, maybe not yet on the backend
+        self._cached: "OrderedDict[str, int]" = OrderedDict()  # local copies, oldest first
+        self._cached_bytes = 0
+        self._pending: Dict[str, int] = {}  # key -> queued writes not yet uploaded
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        if cache_dir:
+            self._journal_dir = os.path.join(cache_dir, PENDING_JOURNAL_DIR)
+            os.makedirs(self._journal_dir, exist_ok=True)
+            self._reset_cache()
+
+    def _reset_cache(self):
+        """
+        Drops read-cache copies from a previous process (they are not indexed)
+        and queues its journaled writes again; their files are kept.
+        """
+        pending = {}
+        for name in os.listdir(self._journal_dir):
+            journal_path = os.path.join(self._journal_dir, name)
+            try:
+                with open(journal_path, encoding="utf-8") as f:
+                    key = normalize_key(f.read().strip())
+            except (OSError, ValueError):
+                key = None
+            if key is None or not os.path.exists(self._cache_path(key)):
+                os.remove(journal_path)
+                continue
+            pending[os.path.basename(self._cache_path(key))] = key
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name == PENDING_JOURNAL_DIR or name in pending:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        for key in sorted(pending.values()):
+            size = os.path.getsize(self._cache_path(key))
+            self._queue_write(key, size, journal=False)
+            self._add_cached(key, size)
+        if pending:
+            print(f"[STORAGE] {len(pending)} write(s) from a previous run queued again")
+            self.start()
+
+    # ---------- metadata ----------
+
+    def _fresh(self, key: str, learned: float) -> bool:
+        return key in self._pending or time.time() - learned < STORAGE_INDEX_TTL_SECONDS
+
+    def size(self, key: str) -> Optional[int]:
+        key = normalize_key(key)
+        with self._lock:
+            if key in self._deleted:
+                return None
+            entry = self._sizes.get(key)
+            if entry and self._fresh(key, entry[1]):
+                return entry[0]
+        size = self.backend.size(key)
+        if size is not None:
+            with self._lock:
+                self._sizes[key] = (size, time.time())
+        return size
+
+    def exists(self, key: str) -> bool:
+        return self.size(key) is not None
+
+    def list(self, prefix: str) -> List[Tuple[str, int]]:
+        """(key, size) of every file under a folder prefix, sorted by key."""
+        prefix = normalize_key(prefix)
+        with self._lock:
+            listed = self._listed.get(prefix)
+            if listed is not None and time.time() - listed < STORAGE_INDEX_TTL_SECONDS:
+                return sorted((k, s) for k, (s, _) in self._sizes.items() if k.startswith(prefix + "/"))
+        found = self.backend.list(prefix)
+        now = time.time()
+        with self._lock:
+            for key in [k for k in self._sizes if k.startswith(prefix + "/") and k not in self._pending]:
+                del self._sizes[key]
+            for key, size in found:
+                if key not in self._deleted and key not in self._pending:
+                    self._sizes[key] = (size, now)
+            self._listed[prefix] = now
+            return sorted((k, s) for k, (s, _) in self._sizes.items() if k.startswith(prefix + "/"))
+
+    def status(self) -> dict:
+        """Write-back state, for monitoring: queued operations and the last upload error."""
+        return {
+            "backend": type(self.backend).__name__,
+            "write_back": self.write_back,
+            "pending": self._queue.unfinished_tasks,
+            "cached_bytes": self._cached_bytes,
+            "last_error": self.last_error,
+        }
+
+    # ---------- reading ----------
+
+    def _cache_path(self, key: str) -> str:
+        # Hashed names keep the cache flat; the extension stays for type detection
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{digest}{os.path.splitext(key)[1].lower()}")
+
+    def _journal_path(self, key: str) -> str:
+        return os.path.join(self._journal_dir, os.path.basename(self._cache_path(key)))
+
+    def local_path(self, key: str) -> Optional[str]:
+        """A path on local disk with the file's content, or None if there is no such file."""
+        key = normalize_key(key)
+        if self.cache_dir is None:
+            return self.backend.path(key) if self.exists(key) else None
+        cache_path = self._cache_path(key)
+        with self._lock:
+            if key in self._cached and os.path.exists(cache_path):
+                self._cached.move_to_end(key)
+                return cache_path
+        if not self.exists(key):
+            return None
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            self.backend.read_to(key, temp_path)
+            os.replace(temp_path, cache_path)
+        except (OSError, KeyError) as e:
+            print(f"[STORAGE] Could not read {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        self._add_cached(key, os.path.getsize(cache_path))
+        return cache_path
+
+    def _add_cached(self, key: str, size: int):
+        with self._lock:
+            old_size = self._cached.pop(key, None)
+            if old_size is not None:
+                self._cached_bytes -= old_size
+            self._cached[key] = size
+            self._cached_bytes += size
+            evicted = []
+            for old_key in list(self._cached):
+                if self._cached_bytes <= self.cache_max_bytes:
+                    break
+                if old_key in self._pending or old_key == key:
+                    continue  # not uploaded yet, or just added
+                self._cached_bytes -= self._cached.pop(old_key)
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._cache_path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def _forget_cached(self, key: str):
+        with self._lock:
+            size = self._cached.pop(key, None)
+            if size is not None:
+                self._cached_bytes -= size
+        for path in (self._cache_path(key), self._journal_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # ---------- writing ----------
+
+    def write_file(self, key: str, src_path: str, background: bool = False) -> str:
+        """
+        Stores a local file under `key`, taking ownership of it (it is moved,
+        not copied). Returns the local path the content can be read from.
+        The file is on the backend when this returns, unless `background` is
+        set for a file that can be regenerated and write-back is on.
+        """
+        key = normalize_key(key)
+        size = os.path.getsize(src_path)
+        if self.cache_dir is None:
+            self.backend.write_from(key, src_path)
+            os.remove(src_path)
+            self._written(key, size)
+            return self.backend.path(key)
+
+        cache_path = self._cache_path(key)
+        if background and self.write_back:
+            # Journaled before it is queued, so a restart finds and uploads it
+            temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+            shutil.move(src_path, temp_path)
+            os.replace(temp_path, cache_path)
+            self._queue_write(key, size)
+            self._add_cached(key, size)
+            self.start()
+            return cache_path
+
+        try:
+            self.backend.write_from(key, src_path)
+        except Exception:
+            os.remove(src_path)
+            raise
+        shutil.move(src_path, cache_path)
+        self._written(key, size)
+        self._add_cached(key, size)
+        return cache_path
+
+    def write_bytes(self, key: str, data: bytes, background: bool = False) -> str:
+        temp_dir = self.cache_dir or tempfile.gettempdir()
+        temp_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.write_file(key, temp_path, background)
+
+    def _written(self, key: str, size: int):
+        with self._lock:
+            self._deleted.discard(key)
+            self._sizes[key] = (size, time.time())
+
+    def _queue_write(self, key: str, size: int, journal: bool = True):
+        with self._lock:
+            if journal:
+                with open(self._journal_path(key), "w", encoding="utf-8") as f:
+                    f.write(key)
+            self._deleted.discard(key)
+            self._sizes[key] = (size, time.time())
+            self._pending[key] = self._pending.get(key, 0) + 1
+        self._queue.put(("write", key))
+
+    def delete(self, key: str):
+        key = normalize_key(key)
+        with self._lock:
+            self._sizes.pop(key, None)
+            self._deleted.add(key)
+            queued = key in self._pending
+        if self.cache_dir is not None:
+            self._forget_cached(key)
+        if queued:
+            # Behind its queued write, so the upload cannot bring the file back
+            self._queue.put(("delete", key))
+            self.start()
+            return
+        self.backend.delete(key)
+        with self._lock:
+            self._deleted.discard(key)
+
+    def delete_prefix(self, prefix: str):
+        """Deletes a whole folder, after any queued uploads into it (which are dropped first)."""
+        prefix = normalize_key(prefix)
+        with self._lock:
+            keys = [k for k in set(self._sizes) | set(self._cached) | set(self._pending) if k.startswith(prefix + "/")]
+            for key in keys:
+                self._sizes.pop(key, None)
+            self._listed.pop(prefix, None)
+        if self.cache_dir is not None:
+            for key in keys:
+                self._forget_cached(key)
+        # Queued writes into the folder now find no file and are skipped; wait for one in flight
+        self.flush(timeout=STORAGE_FLUSH_TIMEOUT_SECONDS)
+        self.backend.delete_prefix(prefix)
+
+    # ---------- write-back ----------
+
+    def start(self):
+        if not self.write_back or (self._worker is not None and self._worker.is_alive()):
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="storage-write-back", daemon=True)
+                self._worker.start()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every queued write and delete reached the backend."""
+        if not self.write_back:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                # Still journaled; uploaded by the next process that starts with this cache
+                print(f"[STORAGE] {self._queue.unfinished_tasks} pending write(s) not flushed")
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _run(self):
+        while True:
+            op, key = self._queue.get()
+            try:
+                self._apply(op, key)
+            finally:
+                self._queue.task_done()
+
+    def _apply(self, op: str, key: str):
+        # Retried until it succeeds: dropping a write would leave the bucket without the file.
+        # The queue waits meanwhile, which keeps later deletes behind it.
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if op == "write":
+                    if not os.path.exists(self._cache_path(key)):
+                        break  # deleted again before it was uploaded
+                    self.backend.write_from(key, self._cache_path(key))
+                else:
+                    self.backend.delete(key)
+                break
+            except OSError as e:
+                self.last_error = f"{op} {key}: {e}"
+                print(f"[STORAGE] ERROR {op} {key} failed (attempt {attempt}), will retry: {e}")
+                time.sleep(min(STORAGE_RETRY_MAX_SECONDS, 2 ** attempt))
+        self.last_error = None
+        with self._lock:
+            if op == "write":
+                remaining = self._pending.get(key, 1) - 1
+                if remaining > 0:
+                    self._pending[key] = remaining
+                else:
+                    self._pending.pop(key, None)
+                    try:
+                        os.remove(self._journal_path(key))
+                    except FileNotFoundError:
+                        pass
+            else:
+                self._deleted.discard(key)
+
+
+def create_storage(backend_name: str = STORAGE_BACKEND, cache_dir: str = STORAGE_CACHE_DIR,
+                   write_back: bool = STORAGE_WRITE_BACK) -> Storage:
+    """
+    The storage for this process. A cache directory belongs to one process:
+    it is cleared on start, so another process (e.g. the bulk export command
+    line next to the server) must be given its own.
+    """
+    if backend_name == "memory":
+        return Storage(MemoryBackend(), cache_dir)
+    if backend_name == "fuse":
+        return Storage(FilesystemBackend(UPLOADS_DIR), cache_dir, write_back=write_back)
+    return Storage(FilesystemBackend(UPLOADS_DIR))
+
+
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def set_storage(store: Storage):
+    """Replaces the process-wide storage; call before anything uses get_storage()."""
+    global _storage
+    with _storage_lock:
+        _storage = store
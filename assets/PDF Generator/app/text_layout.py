@@ -0,0 +1,99 @@
+import fitz
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+
+# Font sizes used when fitting a value into a form field
+MAX_FONTSIZE = 12
+MIN_FONTSIZE = 6
+# A single line that would have to shrink below this is wrapped instead
+READABLE_FONTSIZE = 8
+FONTSIZE_STEP = 0.5
+# Line height factor for wrapped text (PyMuPDF's insert_textbox "lineheight")
+LINE_HEIGHT = 1.0
+MAX_LINES = 3
+# Horizontal padding inside the widget rect
+H_PADDING = 2
+
+
+class TextLayout(NamedTuple):
+    fontsize: float
+    lines: List[str]
+
+    @property
+    def is_multiline(self) -> bool:
+        return len(self.lines) > 1
+
+
+@lru_cache(maxsize=16384)
+def _unit_width(text: str, font: fitz.Font) -> float:
+    # Text width scales linearly with the font size, so one measurement at 1pt
+    # serves every size the layout tries.
+    return font.text_length(text, fontsize=1)
+
+
+def measure(text: str, font: fitz.Font, fontsize: float) -> float:
+    """Returns the width of a shaped string, memoized per (string, font)."""
+    return _unit_width(text, font) * fontsize
+
+
+def _snap(fontsize: float) -> float:
+    """Rounds a font size down to the step grid used by the form."""
+    return int(fontsize / FONTSIZE_STEP) * FONTSIZE_STEP
+
+
+def _wrap(words: List[str], font: fitz.Font, fontsize: float, max_width: float) -> Optional[List[str]]:
+    """Greedy word wrap; returns None if a single word does not fit the width."""
+    space_width = measure(" ", font, fontsize)
+    lines = []
+    current = []
+    current_width = 0.0
+    for word in words:
+        word_width = measure(word, font, fontsize)
+        if word_width > max_width:
+            return None
+        if current and current_width + space_width + word_width > max_width:
+            lines.append(" ".join(current))
+            current = [word]
+            current_width = word_width
+        else:
+            current_width += (space_width if current else 0) + word_width
+            current.append(word)
+    if current:
+        lines.append(" ".join(current))
+    return lines
+
+
+def layout_text(text: str, rect: fitz.Rect, font: fitz.Font) -> TextLayout:
+    """
+    Computes the font size for a value directly from its measured width.
+    If a single line would fall below READABLE_FONTSIZE, the text is wrapped
+    into up to MAX_LINES lines when that allows a larger font size.
+    Lines are returned in logical order; apply bidi per line afterwards.
+    """
+    max_width = rect.width - H_PADDING
+    unit_width = _unit_width(text, font)
+    if unit_width <= 0:
+        return TextLayout(MAX_FONTSIZE, [text])
+
+    single_size = _snap(min(MAX_FONTSIZE, max_width / unit_width))
+    best = TextLayout(max(single_size, MIN_FONTSIZE), [text])
+    if single_size >= READABLE_FONTSIZE:
+        return best
+
+    words = text.split()
+    if len(words) < 2:
+        return best
+
+    descent = max(-font.descender, 0)
+
+    for line_count in range(2, MAX_LINES + 1):
+        # insert_textbox needs line_count line heights plus the last line's descent
+        fontsize = _snap(min(MAX_FONTSIZE, rect.height / (line_count * LINE_HEIGHT + descent)))
+        if fontsize <= best.fontsize or fontsize < MIN_FONTSIZE:
+            break
+        lines = _wrap(words, font, fontsize, max_width)
+        if lines is not None and len(lines) <= line_count:
+            return TextLayout(fontsize, lines)
+
+    return best
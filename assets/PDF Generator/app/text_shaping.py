@@ -0,0 +1,65 @@
+import os
+import re
+from functools import lru_cache
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+
+
+# Number of shaped strings kept per cache (reshape and bidi each)
+SHAPING_CACHE_SIZE = int(os.environ.get("SHAPING_CACHE_SIZE", "4096"))
+
+# Hebrew, Arabic (incl. supplement/extended) and Arabic presentation forms
+_RTL_RE = re.compile("[\u0590-\u08FF\uFB1D-\uFDFF\uFE70-\uFEFF]")
+
+# One preconfigured reshaper instead of the module-level default lookup per call
+_reshaper = arabic_reshaper.ArabicReshaper()
+
+
+def has_rtl(text: str) -> bool:
+    """True if the text contains any right-to-left characters."""
+    return _RTL_RE.search(text) is not None
+
+
+@lru_cache(maxsize=SHAPING_CACHE_SIZE)
+def _reshape_cached(text: str) -> str:
+    return _reshaper.reshape(text)
+
+
+@lru_cache(maxsize=SHAPING_CACHE_SIZE)
+def _display_cached(text: str) -> str:
+    return get_display(text)
+
+
+def reshape(text: str) -> str:
+    """
+    Joins Arabic letters into their presentation forms (logical order).
+    Phone numbers, IDs, dates and other strings without RTL characters are
+    returned unchanged without touching the reshaper.
+    """
+    if not has_rtl(text):
+        return text
+    try:
+        return _reshape_cached(text)
+    except Exception:
+        return text
+
+
+def display(text: str) -> str:
+    """Applies the bidi algorithm to one line, returning it in visual order."""
+    if not has_rtl(text):
+        return text
+    try:
+        return _display_cached(text)
+    except Exception:
+        return text
+
+
+def shape(text: str) -> str:
+    """Reshape and bidi in one step, for single-line text such as titles."""
+    return display(reshape(text))
+
+
+def clear_cache():
+    _reshape_cached.cache_clear()
+    _display_cached.cache_clear()
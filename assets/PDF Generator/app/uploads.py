@@ -0,0 +1,122 @@
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+import uuid
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from . import images, storage
+
+
+# Uploads are read, hashed and written in chunks of this size
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Local disk (not the FUSE mount) where uploads are assembled before they are stored
+UPLOAD_STAGING_DIR = os.environ.get("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "vms_upload_staging"))
+
+
+class StagedUpload:
+    """An upload fully received into a local staging file, with its size and SHA256."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._stat = None  # (size, mtime) when staging finished
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def update(self, chunk: bytes):
+        self.size += len(chunk)
+        self._hash.update(chunk)
+
+    def _finished(self):
+        st = os.stat(self.path)
+        self._stat = (st.st_size, st.st_mtime_ns)
+
+    async def publish(self, key: str) -> str:
+        """
+        Hands the staged file to storage under `key`; it reaches the bucket in
+        one sequential write, as GCS FUSE requires. Returns the local path of
+        the stored file.
+        """
+        st = os.stat(self.path)
+        unchanged = self._stat == (st.st_size, st.st_mtime_ns)
+        try:
+            local_path = await run_in_threadpool(storage.get_storage().write_file, key, self.path)
+        except Exception:
+            await self.discard()
+            raise
+        if unchanged:
+            # The hash is already known, so the first render does not read the file again to hash it
+            images.remember_content_hash(local_path, self.sha256)
+        return local_path
+
+    async def discard(self):
+        try:
+            await aiofiles.os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _new_staged(suffix: str = "") -> StagedUpload:
+    # The suffix keeps the file type visible to validation (see fragments.prepare_attachment)
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    return StagedUpload(os.path.join(UPLOAD_STAGING_DIR, f"{uuid.uuid4().hex}{suffix or '.part'}"))
+
+
+async def stage_file(file: UploadFile, suffix: str = "") -> StagedUpload:
+    """Streams an uploaded file to a staging file chunk by chunk."""
+    staged = _new_staged(suffix)
+    try:
+        async with aiofiles.open(staged.path, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                staged.update(chunk)
+                await out.write(chunk)
+    except Exception:
+        await staged.discard()
+        raise
+    staged._finished()
+    return staged
+
+
+async def stage_base64(data: str) -> StagedUpload:
+    """
+    Decodes a base64 string (optionally a data: URL) to a staging file piece
+    by piece, so the decoded image is never held in memory as a whole.
+    Raises ValueError if the data is not valid base64.
+    """
+    start = data.index("base64,") + len("base64,") if "base64," in data else 0
+    # Whole 4-character groups, so every piece decodes on its own
+    step = UPLOAD_CHUNK_SIZE // 3 * 4
+    staged = _new_staged()
+    try:
+        async with aiofiles.open(staged.path, "wb") as out:
+            for offset in range(start, len(data), step):
+                try:
+                    chunk = base64.b64decode(data[offset:offset + step], validate=True)
+                except binascii.Error as e:
+                    raise ValueError(f"Invalid base64 data: {e}")
+                staged.update(chunk)
+                await out.write(chunk)
+    except Exception:
+        await staged.discard()
+        raise
+    staged._finished()
+    return staged
+
+
+async def save_upload(file: UploadFile, key: str) -> StagedUpload:
+    """Stages an uploaded file, then stores it under `key`."""
+    staged = await stage_file(file, os.path.splitext(key)[1])
+    await staged.publish(key)
+    return staged
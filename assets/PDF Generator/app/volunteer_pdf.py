@@ -0,0 +1,160 @@
+import os
+from typing import List, Optional
+
+from . import bulk_export, database, fragments, models, render_cache, render_pool, storage
+
+
+PDF_TEMPLATE_PATH = "assets/الاستمارة الجديدة الدائمية.pdf"
+
+# Save profiles per endpoint (see pdf_service.SAVE_PROFILES)
+PDF_SAVE_PROFILE = os.environ.get("PDF_SAVE_PROFILE", "fast")
+ZIP_SAVE_PROFILE = os.environ.get("ZIP_SAVE_PROFILE", "compact")
+
+# CPU-bound rendering runs in worker processes (RENDER_WORKERS)
+pdf_render_pool = render_pool.RenderPool(PDF_TEMPLATE_PATH)
+
+
+def volunteer_prefix(volunteer_id: int) -> str:
+    """Storage folder of a volunteer's files (created on first write)."""
+    return f"volunteer_{volunteer_id}"
+
+
+def resolve_upload(path: Optional[str]) -> Optional[str]:
+    """
+    Local path for a stored file key, read through the storage cache.
+    Absolute paths are files from before the storage layer and are used as they are.
+    A missing file resolves to where it would be, so the render logs show it.
+    """
+    if not path or os.path.isabs(path):
+        return path
+    return storage.get_storage().local_path(path) or os.path.join(storage.UPLOADS_DIR, path)
+
+
+def get_attachments_for_pdf(volunteer) -> List[dict]:
+    """Get list of attachments with name and file_path for PDF generation."""
+    file_store = storage.get_storage()
+    attachments = []
+    for att in volunteer.attachment_list:
+        attachment = {"name": att.name, "file_path": resolve_upload(att.file_path)}
+        # Fragment built at upload time (see fragments.prepare_attachment)
+        if att.file_path and not os.path.isabs(att.file_path):
+            attachment["fragment_path"] = file_store.local_path(fragments.stored_fragment_path(att.file_path))
+        attachments.append(attachment)
+    
+    print(f"Found {len(attachments)} attachments for volunteer {volunteer.id}: {attachments}")
+    return attachments
+
+
+def get_pdf_inputs(volunteer) -> dict:
+    """Collect everything needed to render a volunteer's PDF and where to store it."""
+    # Map all 30 text fields to PDF fields (Text1 to Text30)
+    data = {}
+    for i in range(1, 31):
+        val = getattr(volunteer, f"text{i}")
+        data[f"Text{i}"] = val if val else ""
+    
+    # Generate filename from volunteer name (text3 contains the full name)
+    name = volunteer.text3 or f"volunteer_{volunteer.id}"
+    # Replace spaces with underscores and remove any problematic characters
+    safe_name = name.replace(" ", "_").replace("/", "_").replace("\\", "_").replace(":", "_")
+    
+    # Save PDF to volunteer's folder
+    folder_prefix = volunteer_prefix(volunteer.id)
+    output_filename = f"{safe_name}.pdf"
+    
+    return {
+        "data": data,
+        "photo_path": resolve_upload(volunteer.photo_path),
+        "attachments": get_attachments_for_pdf(volunteer),
+        "safe_name": safe_name,
+        "volunteer_prefix": folder_prefix,
+        "output_filename": output_filename,
+        "output_key": f"{folder_prefix}/{output_filename}",
+    }
+
+
+def get_pdf_render_key(inputs: dict, save_profile: str) -> str:
+    return render_cache.render_key(PDF_TEMPLATE_PATH, inputs["data"], inputs["photo_path"],
+                                   inputs["attachments"], save_profile)
+
+
+def load_cached_pdf(inputs: dict, render_key: str, ensure_folder_copy: bool = False) -> Optional[bytes]:
+    """
+    Return a cached render, or None on a miss. On a hit the folder copy is only
+    rewritten when ensure_folder_copy is set and it is missing or differs in size.
+    """
+    output_key = inputs["output_key"]
+    file_store = storage.get_storage()
+    pdf_bytes = render_cache.get_render_cache().get(render_key)
+    if pdf_bytes is None:
+        print(f"[RENDER_CACHE] miss {render_key[:12]}")
+        return None
+    print(f"[RENDER_CACHE] hit {render_key[:12]} ({len(pdf_bytes)} bytes)")
+    if ensure_folder_copy and file_store.size(output_key) != len(pdf_bytes):
+        file_store.write_bytes(output_key, pdf_bytes, background=True)
+    return pdf_bytes
+
+
+def store_rendered_pdf(inputs: dict, render_key: str, pdf_bytes: bytes):
+    """Write the copy in the volunteer's folder and add the render to the cache."""
+    # Regenerable from the render cache, so it may be uploaded in the background
+    storage.get_storage().write_bytes(inputs["output_key"], pdf_bytes, background=True)
+    render_cache.get_render_cache().put(render_key, pdf_bytes)
+
+
+def get_or_render_pdf(inputs: dict, render_key: str, save_profile: str, ensure_folder_copy: bool = False) -> bytes:
+    """Serve a render from the cache, or render it in the pool and store it (blocking)."""
+    pdf_bytes = load_cached_pdf(inputs, render_key, ensure_folder_copy)
+    if pdf_bytes is None:
+        pdf_bytes = pdf_render_pool.render(inputs["data"], inputs["photo_path"], inputs["attachments"], save_profile)
+        store_rendered_pdf(inputs, render_key, pdf_bytes)
+    return pdf_bytes
+
+
+def load_pdf_inputs(volunteer_id: int) -> Optional[dict]:
+    """get_pdf_inputs() for a volunteer ID, using its own DB session (for background work)."""
+    db = database.SessionLocal()
+    try:
+        volunteer = db.query(models.Volunteer).filter(models.Volunteer.id == volunteer_id).first()
+        if not volunteer:
+            return None
+        return get_pdf_inputs(volunteer)
+    finally:
+        db.close()
+
+
+def render_volunteer_pdf(volunteer_id: int, save_profile: str) -> Optional[tuple]:
+    """
+    Render (or fetch from the cache) one volunteer's PDF outside a request.
+    Returns (filename, pdf bytes), or None if not found.
+    """
+    inputs = load_pdf_inputs(volunteer_id)
+    if inputs is None:
+        return None
+    render_key = get_pdf_render_key(inputs, save_profile)
+    return inputs["output_filename"], get_or_render_pdf(inputs, render_key, save_profile)
+
+
+def render_many_volunteers(volunteer_ids: List[int], progress=None, concurrency: int = 0, on_progress=None):
+    """Bulk ZIP export: individual PDFs rendered in parallel, yielded in order."""
+    return bulk_export.render_many(
+        volunteer_ids, lambda volunteer_id: render_volunteer_pdf(volunteer_id, ZIP_SAVE_PROFILE),
+        progress, concurrency or max(1, pdf_render_pool.workers), on_progress
+    )
+
+
+def render_volunteer_parts(volunteer_id: int) -> Optional[tuple]:
+    """One volunteer's fragments for the merged print PDF, rendered in the pool."""
+    inputs = load_pdf_inputs(volunteer_id)
+    if inputs is None:
+        return None
+    parts = pdf_render_pool.batch_parts(inputs["data"], inputs["photo_path"], inputs["attachments"])
+    return inputs["output_filename"], parts
+
+
+def render_volunteer_batch(volunteer_ids: List[int], progress=None, concurrency: int = 0, on_progress=None):
+    """Bulk print export: one merged PDF sharing a single template background."""
+    return bulk_export.iter_batch_pdf(
+        volunteer_ids, render_volunteer_parts, PDF_TEMPLATE_PATH, progress, on_progress,
+        concurrency=concurrency or max(1, pdf_render_pool.workers)
+    )
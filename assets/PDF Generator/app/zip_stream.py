@@ -0,0 +1,101 @@
+import io
+import os
+import time
+import zipfile
+from typing import Iterable, Iterator, Optional, Tuple
+
+
+# Read size when copying a file into the archive
+ZIP_STREAM_CHUNK_SIZE = int(os.environ.get("ZIP_STREAM_CHUNK_SIZE", str(1024 * 1024)))
+
+# Formats that are already compressed; deflating them again costs CPU for no gain
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif",
+    ".pdf", ".zip", ".gz", ".rar", ".7z",
+    ".mp3", ".mp4", ".m4a", ".mov", ".docx", ".xlsx", ".pptx",
+}
+
+# zipfile switches to zip64 on its own for bytes, but streamed entries must declare it up front
+_ZIP64_THRESHOLD = (1 << 31) - 1
+
+
+def compress_type_for(name: str) -> int:
+    """STORED for already-compressed media, DEFLATE for text-like content."""
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class _ChunkWriter(io.RawIOBase):
+    """Unseekable sink for zipfile; collects what was written since the last drain."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """
+    Writes a ZIP archive incrementally. Every method returns (or yields) the
+    archive bytes produced so far, so a response can send them right away and
+    memory stays at about one read chunk regardless of archive size.
+    Entries use data descriptors since the output cannot be seeked back.
+    """
+
+    def __init__(self):
+        self._sink = _ChunkWriter()
+        self._zip = zipfile.ZipFile(self._sink, "w")
+
+    def _info(self, arcname: str, compress_type: Optional[int], mtime: Optional[float] = None) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime(mtime)[:6])
+        info.compress_type = compress_type if compress_type is not None else compress_type_for(arcname)
+        return info
+
+    def write_bytes(self, arcname: str, data: bytes, compress_type: Optional[int] = None) -> bytes:
+        self._zip.writestr(self._info(arcname, compress_type), data)
+        return self._sink.drain()
+
+    def write_file(self, file_path: str, arcname: str, compress_type: Optional[int] = None) -> Iterator[bytes]:
+        """Copies a file into the archive chunk by chunk, yielding output as it is produced."""
+        st = os.stat(file_path)
+        info = self._info(arcname, compress_type, st.st_mtime)
+        with open(file_path, "rb") as src, self._zip.open(info, "w", force_zip64=st.st_size > _ZIP64_THRESHOLD) as dst:
+            yield self._sink.drain()
+            for chunk in iter(lambda: src.read(ZIP_STREAM_CHUNK_SIZE), b""):
+                dst.write(chunk)
+                data = self._sink.drain()
+                if data:
+                    yield data
+        yield self._sink.drain()
+
+    def close(self) -> bytes:
+        """Writes the central directory and returns the final bytes."""
+        self._zip.close()
+        return self._sink.drain()
+
+
+def iter_files(files: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    """
+    Streams a ZIP of (file path, name in archive) pairs, reading each file as it is added.
+    Files that disappeared since they were listed are skipped.
+    """
+    stream = ZipStream()
+    for file_path, arcname in files:
+        try:
+            for data in stream.write_file(file_path, arcname):
+                if data:
+                    yield data
+        except FileNotFoundError:
+            print(f"[ZIP_STREAM] Skipping missing file {file_path}")
+    yield stream.close()
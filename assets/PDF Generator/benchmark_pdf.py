@@ -0,0 +1,254 @@
+"""
+Benchmarks for app/pdf_service.py
+
+Generates synthetic fixtures (large photo, scanned-page images, multi-page PDFs),
+renders a set of scenarios, each in a fresh process, and reports wall time,
+peak RSS and output size. Results can be saved as a baseline and later runs
+compared against it; a regression beyond --tolerance makes the script exit 1.
+
+    python benchmark_pdf.py                              # run all scenarios
+    python benchmark_pdf.py --save-baseline bench.json   # record a baseline
+    python benchmark_pdf.py --baseline bench.json        # compare with it
+    python benchmark_pdf.py --scenario full --repeat 5
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PDF_TEMPLATE_PATH = r"assets/الاستمارة الجديدة الدائمية.pdf"
+DEFAULT_FIXTURES_DIR = os.path.join(tempfile.gettempdir(), "vms_bench_fixtures")
+
+# Bump when the fixture generator changes so old fixture folders are rebuilt
+FIXTURES_VERSION = "1"
+
+SHORT_TEXT = {
+    "Text1": "رقم 001",
+    "Text2": "مجموعة أ-123",
+    "Text3": "احمد محمد علي حسين",
+    "Text4": "بكالوريوس",
+    "Text5": "1990/01/15",
+    "Text6": "متزوج",
+    "Text7": "3",
+    "Text8": "فاطمة علي حسن",
+    "Text9": "07701234567",
+    "Text10": "بغداد - الكرادة",
+}
+
+# Long values that have to wrap or shrink in most fields
+LONG_TEXT = {
+    f"Text{i}": "محافظة بغداد - الكرادة الشرقية - محلة 905 - زقاق 12 - قرب جامع الرحمن والمستوصف الصحي " + str(i)
+    for i in range(1, 31)
+}
+
+# name -> (text set, large photo, image attachments, PDF attachments, append to an existing file)
+SCENARIOS = {
+    "short_text": ("short", False, 0, 0, False),
+    "long_text": ("long", False, 0, 0, False),
+    "large_photo": ("short", True, 0, 0, False),
+    "images_5": ("short", False, 5, 0, False),
+    "images_20": ("short", False, 20, 0, False),
+    "pdfs_5": ("short", False, 0, 5, False),
+    "pdfs_20": ("short", False, 0, 20, False),
+    "append_images_5": ("short", False, 5, 0, True),
+    "full": ("long", True, 5, 5, False),
+}
+
+
+# ============== FIXTURES ==============
+
+def _noisy_image(width: int, height: int, seed: int):
+    """RGB image with gradients and noise, so it compresses like a real photo or scan."""
+    from PIL import Image
+
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    tint = Image.radial_gradient("L").resize((width, height))
+    return Image.merge("RGB", (base, noise, tint))
+
+
+def build_fixtures(fixtures_dir: str) -> dict:
+    """Creates the fixture files once and returns their paths."""
+    import fitz
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    photo = os.path.join(fixtures_dir, "photo_4000x3000.jpg")
+    images = [os.path.join(fixtures_dir, f"scan_{i:02d}.{'png' if i % 4 == 0 else 'jpg'}") for i in range(20)]
+    pdfs = [os.path.join(fixtures_dir, f"document_{i:02d}.pdf") for i in range(20)]
+    marker = os.path.join(fixtures_dir, f"fixtures_v{FIXTURES_VERSION}")
+
+    if not os.path.exists(marker):
+        print(f"Generating fixtures in {fixtures_dir} ...")
+        _noisy_image(4000, 3000, 0).save(photo, quality=95)
+        for i, path in enumerate(images):
+            # A4 at 300 DPI, like a phone scan of an ID card or certificate
+            _noisy_image(2480, 3508, i + 1).save(path, **({} if path.endswith(".png") else {"quality": 90}))
+        for i, path in enumerate(pdfs):
+            doc = fitz.open()
+            for p in range(3):
+                page = doc.new_page()
+                page.insert_text((72, 72), f"Document {i} page {p + 1}", fontsize=18)
+                page.draw_rect(fitz.Rect(72, 100, 523, 770), color=(0.2, 0.2, 0.6))
+            doc.save(path, garbage=3, deflate=True)
+            doc.close()
+        open(marker, "w").close()
+
+    return {"photo": photo, "images": images, "pdfs": pdfs}
+
+
+# ============== SCENARIO RUN (child process) ==============
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(name: str, fixtures_dir: str, repeat: int, profile: str) -> dict:
+    """Renders one scenario `repeat` + 1 times in this process and returns its measurements."""
+    # Derived images must start cold, so every scenario gets its own cache folder
+    os.environ["DERIVED_DIR"] = tempfile.mkdtemp(prefix="vms_bench_derived_")
+    from app import pdf_service
+
+    text_set, with_photo, n_images, n_pdfs, append = SCENARIOS[name]
+    fixtures = build_fixtures(fixtures_dir)
+    data = dict(SHORT_TEXT if text_set == "short" else LONG_TEXT)
+    photo_path = fixtures["photo"] if with_photo else None
+    attachments = [{"name": f"مستمسك {i + 1}", "file_path": p} for i, p in enumerate(fixtures["images"][:n_images])]
+    attachments += [{"name": f"وثيقة {i + 1}", "file_path": p} for i, p in enumerate(fixtures["pdfs"][:n_pdfs])]
+    output_path = os.path.join(tempfile.mkdtemp(prefix="vms_bench_out_"), "output.pdf")
+
+    def once() -> float:
+        start = time.perf_counter()
+        if append:
+            pdf_service.fill_pdf(PDF_TEMPLATE_PATH, output_path, data, photo_path, save_profile=profile)
+            pdf_service.append_attachments_to_pdf(output_path, attachments)
+        else:
+            pdf_service.fill_pdf(PDF_TEMPLATE_PATH, output_path, data, photo_path, attachments, profile)
+        return (time.perf_counter() - start) * 1000
+
+    # The service logs every step; keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cold_ms = once()
+        warm = [once() for _ in range(repeat)]
+
+    return {
+        "cold_ms": round(cold_ms, 1),
+        "warm_ms": round(statistics.median(warm), 1) if warm else None,
+        "peak_rss_mb": _peak_rss_mb(),
+        "output_bytes": os.path.getsize(output_path),
+    }
+
+
+# ============== DRIVER ==============
+
+def run_in_child(name: str, args) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-scenario", name,
+           "--fixtures", args.fixtures, "--repeat", str(args.repeat), "--profile", args.profile]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8")
+    if result.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _delta(value, base) -> str:
+    if value is None or not base:
+        return ""
+    return f"{(value - base) / base * 100:+.0f}%"
+
+
+def print_report(results: dict, baseline: dict = None):
+    columns = ["cold_ms", "warm_ms", "peak_rss_mb", "output_bytes"]
+    header = f"{'scenario':<18}" + "".join(f"{c:>22}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for name, metrics in results.items():
+        row = f"{name:<18}"
+        for c in columns:
+            value = metrics.get(c)
+            cell = "-" if value is None else str(value)
+            if baseline and name in baseline:
+                cell += f" ({_delta(value, baseline[name].get(c)) or 'n/a'})"
+            row += f"{cell:>22}"
+        print(row)
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        # Cold time includes process-wide warm-up and is too noisy to gate on
+        for key in ("warm_ms", "peak_rss_mb", "output_bytes"):
+            value, base_value = metrics.get(key), base.get(key)
+            if value is None or not base_value:
+                continue
+            if value > base_value * (1 + tolerance):
+                regressions.append(f"{name}.{key}: {base_value} -> {value} ({_delta(value, base_value)})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app/pdf_service.py")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="run only this scenario (can be repeated)")
+    parser.add_argument("--repeat", type=int, default=3, help="warm runs per scenario (median is reported)")
+    parser.add_argument("--profile", default="fast", help="save profile passed to fill_pdf")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES_DIR)
+    parser.add_argument("--baseline", help="compare against this baseline JSON")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed slowdown/growth against the baseline (0.15 = 15%%)")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Paths in the app are relative to the project folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, args.fixtures, args.repeat, args.profile)))
+        return 0
+
+    build_fixtures(args.fixtures)
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"Running {name} ...", flush=True)
+        results[name] = run_in_child(name, args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    print()
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())